@@ -1,8 +1,11 @@
 import codecs
+import collections
 import datetime
 import os
 import re
 import sys
+import threading
+import time
 
 from contextlib import contextmanager
 from weakref import WeakValueDictionary
@@ -76,6 +79,57 @@ class SSingleton(type):
         return cls._instances[cls]
 
 
+class SLRUCache:
+    '''Thread-safe dictionary which keeps the 'maxsize' recently used items
+    for 'ttl' seconds at most, and counts the hits and misses.'''
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                value, expires = self._data[key]
+                if expires is None or expires > time.time():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            'hits':     self.hits,
+            'misses':   self.misses,
+            'size':     len(self._data),
+            'maxsize':  self.maxsize,
+        }
+
+
 class SStamp:
     DB_DATETIME = '%Y-%m-%d %H:%M:%S'
     DB_DATE = '%Y-%m-%d'
@@ -17,6 +17,9 @@ class STextFile(SFile):
         self.open_file(path)
 
     def __del__(self):
+        self.close()
+
+    def close(self):
         if self.fd:
             self.fd.close()
 
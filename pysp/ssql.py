@@ -1,26 +1,69 @@
 #!/usr/bin/env python3
 
+import asyncio
+import base64
+import bisect
+import collections
 import copy
+import csv
+import datetime
+import functools
+import heapq
+import itertools
+import json
+import os
+import queue
+import re
 import sqlalchemy as sa
+import threading
+import time
+import zlib
 
-from sqlalchemy import or_, and_  # , event
-# from sqlalchemy.engine import Engine
-from sqlalchemy.orm import sessionmaker
+from concurrent.futures import Future, ThreadPoolExecutor
+from sqlalchemy import or_, and_, event
+from sqlalchemy.orm import scoped_session, sessionmaker
 
+from pysp.sbasic import SLRUCache
+from pysp.scsv import SCSV
+from pysp.serror import SDebug
 
-# @event.listens_for(Engine, "connect")
-# def set_sqlite_pragma(dbapi_connection, connection_record):
-#     module = dbapi_connection.__class__.__module__
-#     if module == 'sqlite3':
-#         print('------------------------------------------->>>')
-#         cursor = dbapi_connection.cursor()
-#         cursor.execute("PRAGMA journal_mode=WAL")
-#         cursor.execute("PRAGMA foreign_keys=ON")
-#         cursor.close()
+
+def _reader(func):
+    '''Give back the connection of the thread after the read.'''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return self._call(func, *args, **kwargs)
+        finally:
+            self._release()
+    return wrapper
+
+
+def _writer(func):
+    '''Serialize the writes, SQLite allows only one writer at a time.'''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self._write_lock:
+            try:
+                return self._call(func, *args, **kwargs)
+            finally:
+                self._release()
+    return wrapper
 
 
-class SSQL(object):
+class SSQL(SDebug):
     TEMP_PREFIX = 'tmp_'
+    MIGRATE_TABLE = 'pysp_migrate'
+    MIGRATE_CHUNK_SIZE = 10000
+    FTS_SUFFIX = '_fts'
+    FTS_MIN_LENGTH = 3
+    SUMMARY_ROWS = '_rows'
+    SUMMARY_AGGREGATES = ['count', 'sum']
+    PARTITION_FORMATS = {
+        'day':      '%Y%m%d',
+        'month':    '%Y%m',
+        'year':     '%Y',
+    }
 
     class Error(Exception):
         pass
@@ -29,14 +72,34 @@ class SSQL(object):
         self.meta = sa.MetaData()
         self.engine = None
         self.config = config
+        self._tables = {}
+        self._fulltext = {}
+        self._partitioned = {}
+        self._partition_tables = {}
+        self._summaries = {}
+        self._summary_rebuild = set()
+        self.migration_stats = {}
+        self.table_cache_hits = 0
+        self.table_cache_misses = 0
 
     def init_tables(self):
         meta = sa.MetaData(bind=self.engine)
         meta.reflect()
         for idx, dictable in enumerate(self.config.get_value('tables')):
+            if 'partition' in dictable:
+                self._init_partitions(meta, dictable)
             self._init_table(meta, dictable)
+        # Reflect every configured table once, the later calls are served
+        # from the cache until a migration invalidates it.
+        self.invalidate_table()
+        for dictable in self.config.get_value('tables'):
+            self.get_table(dictable['name'])
+        for name in sorted(self._summary_rebuild):
+            self.rebuild_summary(name)
+        self._summary_rebuild.clear()
 
     def _init_table(self, meta, dictable):
+        migrated = False
         if dictable['name'] not in meta.tables.keys():
             self._create_table(meta, dictable)
             meta.create_all(self.engine)
@@ -46,11 +109,114 @@ class SSQL(object):
                 operation = dictable['migrate']['operation']
                 if operation == 'drop':
                     self.drop_columns(meta, dictable)
+                    migrated = True
                 elif operation == 'rename':
                     self.rename_columns(meta, dictable)
+                    migrated = True
 
         if 'migrate' in dictable:
             self.config.delete('migrate', dictable)
+        self._init_indexes(dictable)
+        self._init_fulltext(dictable, rebuild=migrated)
+        self._init_summaries(dictable, rebuild=migrated)
+
+    def _init_partitions(self, meta, dictable):
+        '''The table is the template of its partitions, which are the tables
+        of '<name>_<period>' with the same columns, indexes and full-text
+        index.  The existing partitions are checked and migrated like the
+        template.'''
+        tablename = dictable['name']
+        param = dictable['partition']
+        period = param.get('period', 'month')
+        if period not in self.PARTITION_FORMATS:
+            raise SSQL.Error('Unknown Partition Period: {}'.format(period))
+        coltypes = dict([(x[0], x[1]) for x in dictable['columns']])
+        if coltypes.get(param.get('column')) not in ['Date', 'DateTime']:
+            emsg = 'Partition {tn}: Need Date or DateTime Column - {cn}'
+            raise SSQL.Error(emsg.format(tn=tablename, cn=param.get('column')))
+        sample = datetime.date(2000, 1, 1).strftime(
+            self.PARTITION_FORMATS[period])
+        pattern = re.compile(r'^{}_(\d{{{}}})$'.format(
+            re.escape(tablename), len(sample)))
+        tablenames = sorted([x for x in meta.tables.keys()
+                             if pattern.match(x)])
+        for pn in tablenames:
+            self._init_table(meta, self._partition_dict(dictable, pn))
+        self._partitioned[tablename] = dictable
+        self._partition_tables[tablename] = tablenames
+
+    def _partition_dict(self, dictable, partition):
+        suffix = partition[len(dictable['name'])+1:]
+        pdict = copy.deepcopy(dict(dictable))
+        pdict['name'] = partition
+        pdict['partition_of'] = dictable['name']
+        pdict.pop('partition', None)
+        for ixparam in pdict.get('indexes', []):
+            ixparam['name'] = '{}_{}'.format(ixparam['name'], suffix)
+        return pdict
+
+    @staticmethod
+    def _to_datetime(value):
+        if isinstance(value, datetime.datetime):
+            return value
+        return datetime.datetime.combine(value, datetime.time())
+
+    def partition_of(self, tablename, value):
+        '''Return the name of the partition of the date or datetime.'''
+        period = self._partitioned[tablename]['partition'].get(
+            'period', 'month')
+        return '{}_{}'.format(
+            tablename, value.strftime(self.PARTITION_FORMATS[period]))
+
+    def partition_range(self, tablename, partition):
+        '''Return (start, end) datetimes of the rows of the partition.'''
+        period = self._partitioned[tablename]['partition'].get(
+            'period', 'month')
+        start = datetime.datetime.strptime(partition[len(tablename)+1:],
+                                           self.PARTITION_FORMATS[period])
+        if period == 'day':
+            end = start + datetime.timedelta(days=1)
+        elif period == 'month':
+            end = start.replace(year=start.year + start.month // 12,
+                                month=start.month % 12 + 1)
+        else:
+            end = start.replace(year=start.year + 1)
+        return start, end
+
+    def partitions(self, tablename, start=None, end=None):
+        '''Return the partitions of the table in the order of time, which
+        have rows of start <= value < end.'''
+        rv = []
+        for pn in self._partition_tables.get(tablename, []):
+            pstart, pend = self.partition_range(tablename, pn)
+            if start is not None and pend <= self._to_datetime(start):
+                continue
+            if end is not None and pstart >= self._to_datetime(end):
+                continue
+            rv.append(pn)
+        return rv
+
+    def create_partition(self, tablename, partition):
+        if partition in self._partition_tables[tablename]:
+            return
+        meta = sa.MetaData(bind=self.engine)
+        self._init_table(meta, self._partition_dict(
+            self._partitioned[tablename], partition))
+        bisect.insort(self._partition_tables[tablename], partition)
+
+    def drop_partition(self, tablename, partition):
+        '''Drop the partition table with its full-text index, which is the
+        cheap way to delete the rows of a period.'''
+        if partition not in self._partition_tables.get(tablename, []):
+            raise SSQL.Error('Unknown Partition: {}'.format(partition))
+        self._drop_fulltext(partition)
+        self._fulltext.pop(partition, None)
+        self.engine.execute('DROP TABLE IF EXISTS {}'.format(partition))
+        self._partition_tables[tablename].remove(partition)
+        self.invalidate_table(partition)
+        for name, summary in self._summaries.items():
+            if summary[0] == tablename:
+                self.rebuild_summary(name)
 
     def _create_table(self, meta, dictable):
         tablename = dictable['name']
@@ -93,6 +259,232 @@ class SSQL(object):
                 colobj = self.build_column(colparam)
                 self.add_column(self.engine, tablename, colobj)
 
+    def _init_indexes(self, dictable):
+        tablename = dictable['name']
+        indexes = dictable.get('indexes', [])
+        if not indexes:
+            return
+        inspector = sa.inspect(self.engine)
+        exists = {}
+        for ix in inspector.get_indexes(tablename):
+            exists[ix['name']] = ix
+        for ixparam in indexes:
+            ixname = ixparam['name']
+            if ixname not in exists:
+                table = self.get_table(tablename)
+                self.build_index(table, ixparam).create(self.engine)
+                continue
+            ix = exists[ixname]
+            if ix['column_names'] != list(ixparam['columns']):
+                emsg = 'Index {ix}: Not Matched Columns - {a}, {b}'.format(
+                    ix=ixname, a=ixparam['columns'], b=ix['column_names'])
+                raise SSQL.Error(emsg)
+            if bool(ix['unique']) != bool(ixparam.get('unique', False)):
+                emsg = 'Index {ix}: Not Matched Unique Property'
+                raise SSQL.Error(emsg.format(ix=ixname))
+            where = self.get_index_where(ixname)
+            if self._normalize_sql(where) != \
+                    self._normalize_sql(ixparam.get('where')):
+                emsg = 'Index {ix}: Not Matched Where - {a}, {b}'.format(
+                    ix=ixname, a=ixparam.get('where'), b=where)
+                raise SSQL.Error(emsg)
+
+    def _init_fulltext(self, dictable, rebuild=False):
+        '''Keep an external content FTS5 table of the 'fulltext' columns, which
+        is synchronized by triggers in the transaction of each write.'''
+        tablename = dictable['name']
+        colnames = list(dictable.get('fulltext', []))
+        ftsname = tablename + self.FTS_SUFFIX
+        exists = self.engine.execute(
+            'PRAGMA table_info({})'.format(ftsname)).fetchall()
+        if [x[1] for x in exists] != colnames:
+            self._drop_fulltext(tablename)
+            rebuild = True
+            if colnames:
+                sql = 'CREATE VIRTUAL TABLE {fts} USING fts5({cns}, ' \
+                      "content='{tn}', tokenize='trigram')"
+                self.engine.execute(sql.format(
+                    fts=ftsname, tn=tablename, cns=','.join(colnames)))
+        self._fulltext.pop(tablename, None)
+        if not colnames:
+            return
+        form = {
+            'tn':   tablename,
+            'fts':  ftsname,
+            'cns':  ','.join(colnames),
+            'new':  ','.join(['new.' + x for x in colnames]),
+            'old':  ','.join(['old.' + x for x in colnames]),
+        }
+        sql_ins = 'INSERT INTO {fts}(rowid,{cns}) VALUES(new.rowid,{new});'
+        sql_del = "INSERT INTO {fts}({fts},rowid,{cns}) " \
+                  "VALUES('delete',old.rowid,{old});"
+        triggers = {
+            'ai':   ('AFTER INSERT', sql_ins),
+            'ad':   ('AFTER DELETE', sql_del),
+            'au':   ('AFTER UPDATE', sql_del + sql_ins),
+        }
+        for k, (when, body) in triggers.items():
+            sql = 'CREATE TRIGGER IF NOT EXISTS {fts}_%s %s ON {tn} ' \
+                  'BEGIN %s END' % (k, when, body)
+            self.engine.execute(sql.format(**form))
+        if rebuild:
+            self.rebuild_fulltext(tablename)
+        self._fulltext[tablename] = colnames
+
+    def _drop_fulltext(self, tablename):
+        ftsname = tablename + self.FTS_SUFFIX
+        for k in ['ai', 'ad', 'au']:
+            self.engine.execute(
+                'DROP TRIGGER IF EXISTS {}_{}'.format(ftsname, k))
+        self.engine.execute('DROP TABLE IF EXISTS {}'.format(ftsname))
+
+    def rebuild_fulltext(self, tablename):
+        '''Rebuild the full-text index from the content table, the rowids of
+        the content table could be changed by a migration or VACUUM.'''
+        sql = "INSERT INTO {fts}({fts}) VALUES('rebuild')"
+        self.engine.execute(sql.format(fts=tablename + self.FTS_SUFFIX))
+
+    def _init_summaries(self, dictable, rebuild=False):
+        '''Keep the 'summaries' of the table, which are tables of the group
+        columns and the aggregates, count or sum, of the rows of each group.
+        The count of a column counts the rows where it is not NULL.
+        They are updated by triggers in the transaction of each write, and
+        rebuilt when they are created or the table is migrated.'''
+        tablename = dictable['name']
+        source = dictable.get('partition_of', tablename)
+        for row in self.engine.execute(sa.text(
+                'SELECT name FROM sqlite_master WHERE type=:t AND '
+                'tbl_name=:tn'), t='trigger', tn=tablename).fetchall():
+            if row[0].startswith(tablename + '_sum_'):
+                self.engine.execute('DROP TRIGGER IF EXISTS ' + row[0])
+        colparams = dict([(x[0], x) for x in dictable['columns']])
+        for param in dictable.get('summaries', []):
+            name = param['name']
+            groups = list(param.get('groups', []))
+            aggregates = sorted([
+                (k, [v] if isinstance(v, str) else list(v))
+                for k, v in param.get('aggregates', {}).items()])
+            for colname in groups:
+                if colname not in colparams:
+                    emsg = 'Summary {sn}: Unknown Column - {cn}'
+                    raise SSQL.Error(emsg.format(sn=name, cn=colname))
+            for label, agg in aggregates:
+                arity = [0, 1] if agg[:1] == ['count'] else [1]
+                if not agg or agg[0] not in self.SUMMARY_AGGREGATES or \
+                        len(agg) - 1 not in arity or \
+                        any([x not in colparams for x in agg[1:]]):
+                    emsg = 'Summary {sn}: Not Supported Aggregate - {a}'
+                    raise SSQL.Error(emsg.format(sn=name, a=agg))
+            columns = [self.build_column([x, colparams[x][1]]) for x in groups]
+            columns.append(sa.Column(self.SUMMARY_ROWS, sa.Integer))
+            for label, agg in aggregates:
+                coltype = sa.Integer if agg[0] == 'count' else sa.Float
+                columns.append(sa.Column(label, coltype))
+            if self._init_summary_table(name, groups, columns) or rebuild:
+                self._summary_rebuild.add(name)
+            self._init_summary_triggers(tablename, name, groups, aggregates)
+            self._summaries[name] = (source, groups, aggregates)
+
+    def _init_summary_table(self, name, groups, columns):
+        '''Create the table of the summary, or create it again if it has other
+        columns, and return whether it is created.'''
+        exists = self.engine.execute(
+            'PRAGMA table_info({})'.format(name)).fetchall()
+        if [x[1] for x in exists] == [x.name for x in columns]:
+            return False
+        self.engine.execute('DROP TABLE IF EXISTS {}'.format(name))
+        self.invalidate_table(name)
+        meta = sa.MetaData()
+        table = sa.Table(name, meta, *columns)
+        if groups:
+            self.build_index(table, {'name': 'ix_' + name, 'columns': groups,
+                                     'unique': True})
+        meta.create_all(self.engine)
+        return True
+
+    def _init_summary_triggers(self, tablename, name, groups, aggregates):
+        # IS matches NULL groups, which UNIQUE and ON CONFLICT do not.
+        def match(row):
+            return ' AND '.join(['{g} IS {r}.{g}'.format(g=x, r=row)
+                                 for x in groups]) or '1'
+
+        def delta(row, sign):
+            sets = ['{c}={c}{s}1'.format(c=self.SUMMARY_ROWS, s=sign)]
+            for label, agg in aggregates:
+                if agg[0] == 'sum':
+                    value = 'coalesce({}.{},0)'.format(row, agg[1])
+                elif len(agg) > 1:
+                    value = '({}.{} IS NOT NULL)'.format(row, agg[1])
+                else:
+                    value = '1'
+                sets.append('{c}={c}{s}{v}'.format(c=label, s=sign, v=value))
+            return ','.join(sets)
+
+        colnames = groups + [self.SUMMARY_ROWS] + [x[0] for x in aggregates]
+        zeros = ['new.' + x for x in groups] + ['0'] * (len(aggregates) + 1)
+        sql_ins = 'INSERT INTO {sn} ({cns}) SELECT {zeros} WHERE NOT EXISTS ' \
+                  '(SELECT 1 FROM {sn} WHERE {m});' \
+                  'UPDATE {sn} SET {d} WHERE {m};'.format(
+                      sn=name, cns=','.join(colnames), zeros=','.join(zeros),
+                      m=match('new'), d=delta('new', '+'))
+        sql_del = 'UPDATE {sn} SET {d} WHERE {m};' \
+                  'DELETE FROM {sn} WHERE {r}=0 AND {m};'.format(
+                      sn=name, r=self.SUMMARY_ROWS, m=match('old'),
+                      d=delta('old', '-'))
+        triggers = {
+            'ai':   ('AFTER INSERT', sql_ins),
+            'ad':   ('AFTER DELETE', sql_del),
+            'au':   ('AFTER UPDATE', sql_del + sql_ins),
+        }
+        for k, (when, body) in triggers.items():
+            self.engine.execute(
+                'CREATE TRIGGER {tn}_sum_{sn}_{k} {w} ON {tn} BEGIN {b} END'
+                .format(tn=tablename, sn=name, k=k, w=when, b=body))
+
+    def rebuild_summary(self, name):
+        '''Compute the summary again from all rows of its table, and of the
+        partitions of a partitioned table.'''
+        source, groups, aggregates = self._summaries[name]
+        sources = [source] + self._partition_tables.get(source, [])
+        colnames = groups + [self.SUMMARY_ROWS] + [x[0] for x in aggregates]
+        values = groups + ['count(*)'] + [
+            'coalesce(sum({}),0)'.format(agg[1]) if agg[0] == 'sum' else
+            'count({})'.format(agg[1] if len(agg) > 1 else '*')
+            for label, agg in aggregates]
+        needs = list(dict.fromkeys(
+            groups + [agg[1] for label, agg in aggregates
+                      if len(agg) > 1])) or ['1']
+        union = ' UNION ALL '.join(['SELECT {} FROM {}'.format(
+            ','.join(needs), x) for x in sources])
+        sql = 'INSERT INTO {sn} ({cns}) SELECT {vs} FROM ({u})'.format(
+            sn=name, cns=','.join(colnames), vs=','.join(values), u=union)
+        if groups:
+            sql += ' GROUP BY {}'.format(','.join(groups))
+        else:
+            sql += ' HAVING count(*) > 0'
+        with self.engine.begin() as conn:
+            conn.execute('DELETE FROM {}'.format(name))
+            conn.execute(sql)
+
+    def _normalize_sql(self, sql):
+        return ' '.join(sql.split()).lower() if sql else None
+
+    def get_index_where(self, ixname):
+        '''Return the condition of the partial index or None.'''
+        sql = 'SELECT sql FROM sqlite_master WHERE type=:t AND name=:n'
+        row = self.engine.execute(sa.text(sql), t='index', n=ixname).first()
+        if row is None or row[0] is None:
+            return None
+        m = re.search(r'\swhere\s(.*)$', row[0], re.IGNORECASE | re.DOTALL)
+        return m.group(1).strip() if m else None
+
+    def build_index(self, table, ixparam):
+        kwargs = {'unique': bool(ixparam.get('unique', False))}
+        if ixparam.get('where'):
+            kwargs['sqlite_where'] = sa.text(ixparam['where'])
+        columns = [table.c[x] for x in ixparam['columns']]
+        return sa.Index(ixparam['name'], *columns, **kwargs)
+
     def is_valid_type(cls, config_type, sql_type):
         dbtypes = {
             'INTEGER':  'Integer',
@@ -144,8 +536,34 @@ class SSQL(object):
         return sa.Column(*args, **kwargs)
 
     def get_table(self, tablename):
-        return sa.Table(tablename, self.meta, autoload=True,
-                        autoload_with=self.engine)
+        table = self._tables.get(tablename)
+        if table is not None:
+            self.table_cache_hits += 1
+            return table
+        self.table_cache_misses += 1
+        table = sa.Table(tablename, self.meta, autoload=True,
+                         autoload_with=self.engine)
+        self._tables[tablename] = table
+        return table
+
+    def invalidate_table(self, tablename=None):
+        '''Drop the reflected table from the cache, or all tables if the
+        tablename is not given.'''
+        if tablename is None:
+            tablenames = list(self._tables.keys())
+        else:
+            tablenames = [tablename]
+        for tn in tablenames:
+            self._tables.pop(tn, None)
+            if tn in self.meta.tables:
+                self.meta.remove(self.meta.tables[tn])
+
+    def table_cache_stats(self):
+        return {
+            'hits':     self.table_cache_hits,
+            'misses':   self.table_cache_misses,
+            'tables':   len(self._tables),
+        }
 
     def add_column(self, engine, tablename, column):
         colname = column.compile(dialect=engine.dialect)
@@ -153,44 +571,134 @@ class SSQL(object):
         sql = 'ALTER TABLE %s ADD COLUMN %s %s' % (tablename, colname, coltype)
         # print(sql)
         engine.execute(sql)
+        self.invalidate_table(tablename)
 
-    def _drop_columns(self, meta, dictable, colnames):
-        # BEGIN TRANSACTION;
-        # ## XXX: This function worked, but lost each the columns property !!
-        # ## CREATE TABLE t1_backup AS SELECT a, b FROM t1;
-        # CREATE TABLE t1_backup ( columns with property )
-        # INSERT INTO t1_backup SELECT a, b FROM t1;
-        # DROP TABLE t1;
-        # ALTER TABLE t1_backup RENAME TO t1;
-        # COMMIT;
+    def _migrate_form(self, dictable, colnames):
         tablename = dictable['name']
-        dictable['name'] = self.TEMP_PREFIX + tablename
-        sqls = ['INSERT INTO tmp_{tn} SELECT {cns} FROM {tn}',
-                'DROP TABLE {tn}',
-                'ALTER TABLE tmp_{tn} RENAME TO {tn}']
-        form = {
+        tmpname = self.TEMP_PREFIX + tablename
+        tcols = [x[0] for x in dictable['columns']]
+        return {
             'tn':   tablename,
-            'ttn':  dictable['name'],
-            'cns':  ','.join(colnames)
+            'ttn':  tmpname,
+            'mt':   self.MIGRATE_TABLE,
+            'cns':  ','.join(colnames),
+            'tcns': ','.join(tcols),
+            'new':  ','.join(['NEW.' + x for x in colnames]),
         }
-        # Check to exist tmp_tablename
-        try:
-            self.get_table(form['ttn'])
+
+    def _migrate_progress(self, form):
+        sql = 'CREATE TABLE IF NOT EXISTS {mt} (name VARCHAR PRIMARY KEY, ' \
+              'last_rowid INTEGER, copied INTEGER)'
+        self.engine.execute(sql.format(**form))
+        sql = 'SELECT last_rowid, copied FROM {mt} WHERE name=:tn'
+        return self.engine.execute(sa.text(sql.format(**form)),
+                                   tn=form['tn']).first()
+
+    def _migrate_triggers(self, form):
+        '''Mirror the writes on the copied rows to the temporary table while
+        the rows are copied in chunks.'''
+        last = '(SELECT last_rowid FROM {mt} WHERE name=\'{tn}\')'
+        ins = 'INSERT OR REPLACE INTO {ttn} (rowid,{tcns}) ' \
+              'SELECT NEW.rowid,{new} WHERE NEW.rowid <= %s;' % last
+        dele = 'DELETE FROM {ttn} WHERE rowid=OLD.rowid;'
+        triggers = {
+            'ai':   ('AFTER INSERT', ins),
+            'ad':   ('AFTER DELETE', dele),
+            'au':   ('AFTER UPDATE', dele + ins),
+        }
+        for k, (when, body) in triggers.items():
+            sql = 'CREATE TRIGGER IF NOT EXISTS {ttn}_%s %s ON {tn} ' \
+                  'BEGIN %s END' % (k, when, body)
+            self.engine.execute(sql.format(**form))
+
+    def _migrate_chunk(self, form, last, limit=None):
+        '''Copy the rows after the rowid 'last' in a transaction, and return
+        the last copied rowid and the number of rows.'''
+        sql = 'SELECT max(rowid) FROM (SELECT rowid FROM {tn} ' \
+              'WHERE rowid > :last ORDER BY rowid LIMIT :limit)'
+        upto = self.session.execute(
+            sa.text(sql.format(**form)),
+            {'last': last, 'limit': -1 if limit is None else limit}).scalar()
+        if upto is None:
+            return last, 0
+        sql = 'INSERT INTO {ttn} (rowid,{tcns}) ' \
+              'SELECT rowid,{cns} FROM {tn} ' \
+              'WHERE rowid > :last AND rowid <= :upto ORDER BY rowid'
+        rv = self.session.execute(sa.text(sql.format(**form)),
+                                  {'last': last, 'upto': upto})
+        sql = 'UPDATE {mt} SET last_rowid=:upto, copied=copied+:n ' \
+              'WHERE name=:tn'
+        self.session.execute(sa.text(sql.format(**form)),
+                             {'upto': upto, 'n': rv.rowcount,
+                              'tn': form['tn']})
+        return upto, rv.rowcount
+
+    def _drop_columns(self, meta, dictable, colnames):
+        # The rows are copied to tmp_tablename in chunks of the rowid order,
+        # each chunk is a short transaction and the progress is recorded in
+        # MIGRATE_TABLE, so an interrupted migration resumes from the last
+        # chunk.  While copying, triggers mirror the writes on the copied rows.
+        # At last, in one transaction:
+        #   INSERT INTO tmp_t1 SELECT a, b FROM t1 WHERE rowid > last;
+        #   DROP TABLE t1;
+        #   ALTER TABLE tmp_t1 RENAME TO t1;
+        form = self._migrate_form(dictable, colnames)
+        progress = self._migrate_progress(form)
+        tables = sa.inspect(self.engine).get_table_names()
+        tmp_exists = form['ttn'] in tables
+        if tmp_exists and progress is None:
             emsg = 'Already Exists Table "{ttn}"'
             raise SSQL.Error(emsg.format(**form))
-        except sa.exc.NoSuchTableError:
+        if not tmp_exists:
+            tablename = dictable['name']
+            dictable['name'] = form['ttn']
             self._create_table(meta, dictable)
             meta.create_all(self.engine)
+            # Restore the name of table
+            dictable['name'] = tablename
+            sql = 'INSERT OR REPLACE INTO {mt} VALUES (:tn, :last, 0)'
+            self.engine.execute(sa.text(sql.format(**form)),
+                                tn=form['tn'], last=-2**63)
+            progress = self._migrate_progress(form)
+        self._migrate_triggers(form)
 
-        self.session.begin_nested()
+        last, copied = progress
+        started = time.time()
+        rows = 0
         try:
-            for sql in sqls:
+            while True:
+                self.session.begin_nested()
+                last, count = self._migrate_chunk(
+                    form, last, self.MIGRATE_CHUNK_SIZE)
+                self.session.commit()
+                rows += count
+                if count == 0:
+                    break
+            self.session.begin_nested()
+            last, count = self._migrate_chunk(form, last)
+            rows += count
+            for sql in ['DROP TABLE {tn}',
+                        'ALTER TABLE {ttn} RENAME TO {tn}',
+                        'DELETE FROM {mt} WHERE name=\'{tn}\'']:
                 self.session.execute(sql.format(**form))
             self.session.commit()
-        except Exception:
+        except Exception as e:
             self.session.rollback()
-        # Restore the name of table
-        dictable['name'] = tablename
+            emsg = 'Migrate {tn}: Stopped after rowid %d - %s' % (last, e)
+            raise SSQL.Error(emsg.format(**form))
+        finally:
+            self.invalidate_table(form['tn'])
+            self.invalidate_table(form['ttn'])
+
+        seconds = max(time.time() - started, 1e-6)
+        self.migration_stats[form['tn']] = {
+            'rows':         rows,
+            'total':        copied + rows,
+            'seconds':      seconds,
+            'rows_per_sec': rows / seconds,
+        }
+        self.dprint('Migrate {tn}: {r} rows, {s:.3f} sec, {rps:.1f} rows/s'
+                    .format(r=rows, s=seconds, rps=rows / seconds, **form))
 
     def drop_columns(self, meta, dictable):
         '''It handles columns of a table to the process of dropping and adding,
@@ -219,27 +727,172 @@ class SSimpleDB(SSQL):
     OP_OR = 'or'
     SQL_PAGE = 'page'
     SQL_SIZE = 'size'
+    SQL_CURSOR = 'cursor'
+    SQL_ORDER = 'order'
     SQL_V_PAGE = 0
     SQL_V_SIZE = 5
+    SQL_BATCH = 'batch'
+    SQL_V_BATCH = 1000
+    BULK_CHUNK_SIZE = 500
+    POOL_SIZE = 5
+    POOL_OVERFLOW = 10
+    STATEMENT_CACHE_SIZE = 256
+    RESULT_CACHE_SIZE = 0
+    APPROX_COUNT_TTL = 10.0
+    EXPORT_QUEUE_SIZE = 8
+    LOOKUP_CHUNK_SIZE = 900
+    LOOKUP_TEMP_SIZE = 4000
+    LOOKUP_TABLE = 'pysp_lookup'
+    AGGREGATES = {
+        'count':    sa.func.count,
+        'sum':      sa.func.sum,
+        'min':      sa.func.min,
+        'max':      sa.func.max,
+        'avg':      sa.func.avg,
+    }
+    RE_SCSV_STR = re.compile(r'^="(.*)"$', re.DOTALL)
+    SQL_PRAGMAS = {
+        'journal_mode':     'WAL',
+        'foreign_keys':     'ON',
+    }
+    SQL_PROFILES = {
+        'default':          {},
+        'bulk-load': {
+            'synchronous':          'OFF',
+            'cache_size':           -262144,
+            'temp_store':           'MEMORY',
+            'mmap_size':            0,
+            'wal_autocheckpoint':   10000,
+        },
+        'read-mostly': {
+            'synchronous':          'NORMAL',
+            'cache_size':           -65536,
+            'temp_store':           'MEMORY',
+            'mmap_size':            268435456,
+            'wal_autocheckpoint':   1000,
+        },
+        'durable': {
+            'synchronous':          'FULL',
+            'cache_size':           -2000,
+            'temp_store':           'DEFAULT',
+            'mmap_size':            0,
+            'wal_autocheckpoint':   1000,
+        },
+    }
 
-    def __init__(self, dbpath, config):
+    def __init__(self, dbpath, config, **kwargs):
+        '''
+        param threadsafe - Use a session per thread over a pool of connections
+                           instead of one session for the whole object.  The
+                           reads run in parallel and the writes are serialized.
+        param pool_size, pool_overflow - Connection pool of the threadsafe mode
+        param statement_cache_size - Number of compiled statements to keep
+        param result_cache_size - Number of query and count results to keep,
+                                  0 disables the result cache
+        param result_cache_ttl - Seconds to keep a cached result, optional
+        param instrument - Keep SQueryStats of the statements in 'query_stats'
+        param slow_query - Seconds over which a statement is logged with its
+                           query plan, it turns on 'instrument'
+        param slow_query_log - File which the slow statements are appended
+                               to as JSON lines, optional
+        param profile - Name of SQL_PROFILES which is applied to every new
+                        connection, instead of 'sqlite.profile' of the config
+        '''
         super(SSimpleDB, self).__init__(config)
+        self.dbpath = dbpath
+        self.threadsafe = kwargs.get('threadsafe', False)
+        self._write_lock = threading.RLock()
+        self._statements = SLRUCache(
+            kwargs.get('statement_cache_size', self.STATEMENT_CACHE_SIZE))
+        self._counts = {}
+        self._count_lock = threading.Lock()
+        size = kwargs.get('result_cache_size', self.RESULT_CACHE_SIZE)
+        self._results = SLRUCache(size, kwargs.get('result_cache_ttl')) \
+            if size > 0 else None
+        self._generations = collections.Counter()
+        engine_kwargs = {'echo': self.SQL_ECHO}
+        if self.threadsafe:
+            engine_kwargs.update({
+                'poolclass':    sa.pool.QueuePool,
+                'pool_size':    kwargs.get('pool_size', self.POOL_SIZE),
+                'max_overflow': kwargs.get('pool_overflow',
+                                           self.POOL_OVERFLOW),
+                'connect_args': {'check_same_thread': False},
+            })
         self.engine = sa.create_engine(
-            'sqlite:///{db}'.format(db=dbpath), echo=self.SQL_ECHO)
+            'sqlite:///{db}'.format(db=dbpath), **engine_kwargs)
+        self.query_stats = None
+        slow_query = kwargs.get('slow_query')
+        if kwargs.get('instrument', False) or slow_query is not None:
+            self.query_stats = SQueryStats(
+                slow_query=slow_query,
+                slow_query_log=kwargs.get('slow_query_log'))
+            self.query_stats.attach(self.engine)
+        self.pragmas = self.get_pragmas(kwargs.get('profile'))
+        event.listen(self.engine, 'connect',
+                     functools.partial(self._set_pragmas, self.pragmas))
         Session = sessionmaker(bind=self.engine)
-        self.session = Session()
-        if self.session.bind.dialect.name == 'sqlite':
-            self.session.execute("PRAGMA journal_mode=WAL")
-            self.session.execute("PRAGMA foreign_keys=ON")
-            self.session.commit()
+        if self.threadsafe:
+            self.session = scoped_session(Session)
+        else:
+            self.session = Session()
         self.init_tables()
 
+    def get_pragmas(self, profile=None):
+        '''Return the PRAGMAs of the profile, which is given or selected by
+        'sqlite.profile' of the config, with 'sqlite.pragmas' of the config
+        on top of it.'''
+        if profile is None:
+            profile = self.config.get_value('sqlite.profile', 'default')
+        if profile not in self.SQL_PROFILES:
+            raise SSimpleDB.Error('Unknown Profile: {}'.format(profile))
+        pragmas = collections.OrderedDict(self.SQL_PRAGMAS)
+        pragmas.update(self.SQL_PROFILES[profile])
+        pragmas.update(self.config.get_value('sqlite.pragmas', None) or {})
+        if 'auto_vacuum' in pragmas:
+            # It takes effect only before the WAL mode writes the new file.
+            pragmas.move_to_end('auto_vacuum', last=False)
+        return pragmas
+
+    @staticmethod
+    def _set_pragmas(pragmas, dbapi_connection, connection_record):
+        '''It does not hold the object, so the engine does not keep it alive
+        after the last reference is deleted.'''
+        cursor = dbapi_connection.cursor()
+        for k, v in pragmas.items():
+            cursor.execute('PRAGMA {}={}'.format(k, v))
+        cursor.close()
+
     def __del__(self):
         if hasattr(self, 'session'):
-            self.session.close()
+            if getattr(self, 'threadsafe', False):
+                self.session.remove()
+            else:
+                self.session.close()
         if self.config and hasattr(self.config, 'store'):
             self.config.store()
 
+    def _call(self, func, *args, **kwargs):
+        '''Run the API, and let the statements of the thread be counted for
+        the outermost API under the instrumentation.'''
+        stats = self.query_stats
+        if stats is None or getattr(stats.local, 'api', None):
+            return func(self, *args, **kwargs)
+        stats.local.api = func.__name__
+        try:
+            rv = func(self, *args, **kwargs)
+            if type(rv) is list:
+                stats.add_rows(func.__name__, len(rv))
+            return rv
+        finally:
+            stats.local.api = None
+
+    def _release(self):
+        '''In the threadsafe mode, the session of the current thread is closed
+        and its connection goes back to the pool.'''
+        if self.threadsafe:
+            self.session.remove()
+
     def to_sql(self, o):
         return str(o.compile(compile_kwargs={"literal_binds": True}))
 
@@ -254,6 +907,75 @@ class SSimpleDB(SSQL):
         table = self.get_table(tablename)
         return [x.name for x in table.c]
 
+    def _where_terms(self, table, wheres):
+        '''Split the wheres to terms of (colname, is_list, binds) and each bind
+        is (kind, name, value).  The kinds and names are the shape of the
+        statement and the values are its parameters.  None of a non-string
+        column is the 'null' kind of IS NULL.  A list of non-strings is one
+        IN of an expanding parameter, ORed with IS NULL if it has None.  A
+        string is filtered by LIKE, or by MATCH of the full-text index which
+        finds the same substrings with the trigram tokenizer.'''
+        fulltext = self._fulltext.get(table.name, [])
+        terms = []
+        for i, (k, v) in enumerate(wheres.items()):
+            column = table.c[k]
+            is_str = column.type.__class__.__name__ in ['VARCHAR', 'CHAR']
+            binds = []
+            if type(v) is list and v and not is_str:
+                # One expanding IN, the statement does not vary by the size.
+                values = [x for x in v if x is not None]
+                if values:
+                    binds.append(('in', 'w{}'.format(i), values))
+                if len(values) < len(v):
+                    binds.append(('null', 'w{}_n'.format(i), None))
+                terms.append((k, True, binds))
+                continue
+            for j, _v in enumerate(v if type(v) is list else [v]):
+                name = 'w{}_{}'.format(i, j)
+                if not is_str:
+                    binds.append(('null' if _v is None else 'eq', name, _v))
+                elif k in fulltext and len(str(_v)) >= self.FTS_MIN_LENGTH:
+                    phrase = '{cn} : "{v}"'.format(
+                        cn=k, v=str(_v).replace('"', '""'))
+                    binds.append(('fts', name, phrase))
+                else:
+                    binds.append(('like', name, '%{}%'.format(_v)))
+            terms.append((k, type(v) is list, binds))
+        return terms
+
+    def _where_key(self, terms, operate):
+        return (operate, tuple([(k, is_list, tuple([x[0] for x in binds]))
+                                for k, is_list, binds in terms]))
+
+    def _where_params(self, terms):
+        params = {}
+        for k, is_list, binds in terms:
+            for kind, name, value in binds:
+                if kind != 'null':
+                    params[name] = value
+        return params
+
+    def _term_clause(self, table, colname, kind, name, value):
+        column = table.c[colname]
+        if kind == 'null':
+            return column.is_(None)
+        if kind == 'in':
+            return column.in_(sa.bindparam(name, value, expanding=True))
+        param = sa.bindparam(name, value)
+        if kind == 'eq':
+            return column == param
+        if kind == 'ge':
+            return column >= param
+        if kind == 'lt':
+            return column < param
+        if kind == 'like':
+            return column.like(param)
+        ftsname = table.name + self.FTS_SUFFIX
+        qm = sa.sql.select([sa.literal_column('rowid')]) \
+            .select_from(sa.table(ftsname)) \
+            .where(sa.literal_column(ftsname).op('MATCH')(param))
+        return sa.literal_column(table.name + '.rowid').in_(qm)
+
     def _append_wheres(self, qo, table, **kwargs):
         wheres = kwargs.pop('wheres', {})
         operate = kwargs.pop('operate', self.OP_AND)
@@ -263,34 +985,123 @@ class SSimpleDB(SSQL):
         }
         if wheres:
             filters = []
-            for k, v in wheres.items():
-                # column = sa.sql.column(k)
-                column = table.c[k]
-                is_str = column.type.__class__.__name__ in ['VARCHAR', 'CHAR']
-                if type(v) is list:
-                    _o = None
-                    for _v in v:
-                        if _o is None:
-                            if is_str:
-                                _o = or_(column.like('%{}%'.format(_v)))
-                            else:
-                                _o = or_(column == _v)
-                        else:
-                            if is_str:
-                                _o = or_(column.like('%{}%'.format(_v)), _o)
-                            else:
-                                _o = or_(column == _v, _o)
-                    if _o is not None:
-                        filters.append(_o)
+            for k, is_list, binds in self._where_terms(table, wheres):
+                if is_list:
+                    if binds:
+                        filters.append(or_(*[
+                            self._term_clause(table, k, *x) for x in binds]))
                 else:
-                    if is_str:
-                        colike = column.like('%{}%'.format(v))
-                        filters.append(_op[operate](colike))
-                    else:
-                        filters.append(_op[operate](column == v))
+                    _c = self._term_clause(table, k, *binds[0])
+                    filters.append(_op[operate](_c))
             qo = qo.where(_op[operate](*filters))
+        ranges = kwargs.pop('ranges', {})
+        for k, is_list, binds in self._range_terms(table, ranges):
+            for bind in binds:
+                qo = qo.where(self._term_clause(table, k, *bind))
         return qo
 
+    def _range_terms(self, table, ranges):
+        '''Split the ranges, a dict of the column to (start, end) which is
+        start <= column < end, to terms like _where_terms().  A bound of None
+        is open.  The ranges are joined to the wheres by AND.'''
+        terms = []
+        for i, (k, bounds) in enumerate(sorted(ranges.items())):
+            is_dt = table.c[k].type.__class__.__name__ == 'DATETIME'
+            binds = []
+            for j, (kind, v) in enumerate(zip(['ge', 'lt'], bounds)):
+                if v is None:
+                    continue
+                if is_dt:
+                    v = self._to_datetime(v)
+                binds.append((kind, 'r{}_{}'.format(i, j), v))
+            terms.append((k, False, binds))
+        return terms
+
+    def _statement(self, name, table, *args, **kwargs):
+        '''Return the key and the parameters of a statement in the cache.'''
+        terms = self._where_terms(table, kwargs.get('wheres', {})) + \
+            self._range_terms(table, kwargs.get('ranges', {}))
+        operate = kwargs.get('operate', self.OP_AND)
+        key = (name, table.name, args, self._where_key(terms, operate))
+        return key, self._where_params(terms)
+
+    def _execute_cached(self, key, build, params, conn=None):
+        '''Execute the compiled statement of the key with the parameters,
+        the statement is built and compiled only on a miss of the cache.'''
+        compiled = self._statements.get(key)
+        if compiled is None:
+            compiled = build().compile(dialect=self.engine.dialect)
+            self._statements.set(key, compiled)
+        if conn is None:
+            conn = self.session.connection()
+        try:
+            return conn.execute(compiled, params)
+        except Exception as e:
+            try:
+                sql = self.to_sql(build())
+            except Exception:
+                sql = str(compiled)
+            emsg = '{}: {}: {}'.format(key[0], sql, e)
+            raise SSimpleDB.Error(emsg)
+
+    def statement_cache_stats(self):
+        return self._statements.stats()
+
+    def result_cache_stats(self):
+        return self._results.stats() if self._results is not None else None
+
+    def _result_key(self, name, tablename, args, kwargs):
+        '''Normalize the call into a key of the result cache, or return None
+        if a parameter can not be a part of the key.'''
+        items = []
+        for k, v in sorted(kwargs.items()):
+            if type(v) is dict:
+                v = tuple(sorted(
+                    [(wk, tuple(wv) if type(wv) is list else wv)
+                     for wk, wv in v.items()]))
+            items.append((k, v))
+        key = (name, tablename, self._generations[tablename], args,
+               tuple(items))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _cached_result(self, key, run):
+        '''The key holds the generation of the table which is read before the
+        run, so a result which is read before a write is never returned after
+        the write was completed.'''
+        if self._results is None or key is None:
+            return run()
+        rv = self._results.get(key, self._results)
+        if rv is self._results:
+            rv = run()
+            self._results.set(key, rv)
+        return list(rv) if type(rv) is list else rv
+
+    def _bump_generation(self, tablename=None):
+        with self._count_lock:
+            if tablename is None:
+                for name in list(self._generations.keys()):
+                    self._generations[name] += 1
+            else:
+                self._generations[tablename] += 1
+
+    def invalidate_table(self, tablename=None):
+        super(SSimpleDB, self).invalidate_table(tablename)
+        self._statements.clear()
+        self._bump_generation(tablename)
+        if tablename is None and self._results is not None:
+            self._results.clear()
+        self._drop_counts(tablename)
+
+    def _drop_counts(self, tablename=None):
+        with self._count_lock:
+            for key in list(self._counts.keys()):
+                if tablename is None or key[1] == tablename:
+                    del self._counts[key]
+
     def _build_query(self, table, *args, **kwargs):
         columns = self._get_columns(table, args)
 
@@ -298,93 +1109,1409 @@ class SSimpleDB(SSQL):
         qo = self._append_wheres(qo, table, **kwargs)
         return qo
 
-    def upsert(self, tablename, **kwargs):
-        tbl = self.get_table(tablename)
-        data = kwargs.get('data')
-        only_insert = kwargs.get('only_insert', False)
-        rv = False
+    def _upsert_row(self, tbl, data, only_insert):
+        '''Upsert a row in the current transaction, and return the result of
+        upsert() and whether the row was inserted.'''
         pk = next(iter(data))
         # pk_column = sa.sql.column(pk)
         pk_column = tbl.c[pk]
+        if any([isinstance(x, sa.sql.ClauseElement) for x in data.values()]):
+            return self._upsert_expression(tbl, data, only_insert)
 
+        # The statements of the columns are compiled once with binds.
+        colnames = tuple(data.keys())
+        values = dict([('_v%d' % i, data[x]) for i, x in enumerate(colnames)])
+        binds = dict([(x, sa.bindparam('_v%d' % i))
+                      for i, x in enumerate(colnames)])
+
+        def build_select():
+            return sa.sql.select([pk_column]).where(
+                pk_column == sa.bindparam('_pk'))
+
+        def build_insert():
+            return sa.insert(tbl).values(binds)
+
+        def build_update():
+            return sa.update(tbl).values(binds).where(
+                pk_column == sa.bindparam('_pk'))
+
+        key = ('Upsert', tbl.name, colnames)
+        item = self._execute_cached(key + ('select',), build_select,
+                                    {'_pk': data[pk]}).first()
+        if item is None:
+            self._execute_cached(key + ('insert',), build_insert, values)
+            return True, True
+        if only_insert:
+            return False, False
+        values['_pk'] = data[pk]
+        self._execute_cached(key + ('update',), build_update, values)
+        return True, False
+
+    def _upsert_expression(self, tbl, data, only_insert):
+        '''Upsert a row which has SQL expressions in its values.'''
+        pk = next(iter(data))
+        pk_column = tbl.c[pk]
         qc = sa.sql.select([tbl.c[pk]]).where(pk_column == data[pk])
-        qi = sa.insert(tbl).values(**data)
+        item = self.session.query(qc).first()
+        if item is None:
+            self.session.execute(sa.insert(tbl).values(**data))
+            return True, True
+        if only_insert:
+            return False, False
         qu = sa.update(tbl).values(**data).where(pk_column == data[pk])
+        self.session.execute(qu)
+        return True, False
+
+    @_writer
+    def upsert(self, tablename, **kwargs):
+        '''A row of a partitioned table goes to the partition of its date.
+        The primary key is unique across the partitions, an upsert of a key
+        which is in another partition raises SSimpleDB.Error, as the rows do
+        not move between the partitions.'''
+        data = kwargs.get('data')
+        partition = self._route(tablename, data)
+        if partition != tablename:
+            self._check_keys(tablename, partition, [data])
+            self.create_partition(tablename, partition)
+            rv = self.upsert(partition, **kwargs)
+            self._notify_write(tablename)
+            return rv
+        tbl = self.get_table(tablename)
+        only_insert = kwargs.get('only_insert', False)
+        rv = False
         self.session.begin_nested()
         try:
-            item = self.session.query(qc).first()
-            if item is None:
-                self.session.execute(qi)
-                rv = True
-            else:
-                if only_insert:
-                    rv = False
-                else:
-                    self.session.execute(qu)
-                    rv = True
+            rv, inserted = self._upsert_row(tbl, data, only_insert)
             self.session.commit()
+            self._notify_write(tablename, inserted=1 if inserted else 0)
         except Exception:
             self.session.rollback()
+            rv = False
         return rv
 
+    @_writer
+    def update_where(self, tablename, values, **kwargs):
+        '''Set the values, a dict of the column to its value, to the rows of
+        the wheres, and return the number of the updated rows.
+        param limit - Update in chunks of the rows in the primary key order
+                      and commit each chunk, instead of one statement
+        '''
+        tbl = self.get_table(tablename)
+        for colname in values.keys():
+            if colname not in tbl.c:
+                raise SSimpleDB.Error('Unknown Column: {}'.format(colname))
+        parts = self._pruned(tablename, kwargs)
+        if parts is not None:
+            try:
+                return sum([self.update_where(pn, values, **kwargs)
+                            for pn in parts])
+            finally:
+                self._notify_write(tablename)
+        return self._write_where(tbl, tbl.update().values(**values), False,
+                                 **kwargs)
+
+    @_writer
+    def delete_where(self, tablename, **kwargs):
+        '''Delete the rows of the wheres, and return the number of the deleted
+        rows.  Without wheres, all rows are deleted.
+        param limit - Delete in chunks of the rows in the primary key order
+                      and commit each chunk, instead of one statement
+        '''
+        parts = self._pruned(tablename, kwargs)
+        if parts is not None:
+            try:
+                return sum([self.delete_where(pn, **kwargs) for pn in parts])
+            finally:
+                self._notify_write(tablename)
+        tbl = self.get_table(tablename)
+        return self._write_where(tbl, tbl.delete(), True, **kwargs)
+
+    def _write_where(self, tbl, stmt, deletes, **kwargs):
+        '''Run the statement on the rows of the wheres, and notify the written
+        rows, also the chunks which were committed before a failed one.'''
+        limit = kwargs.pop('limit', None)
+        count = 0
+        committed = False
+        try:
+            if not limit:
+                count = self._write_chunk(
+                    stmt, self._append_wheres(stmt, tbl, **kwargs))
+                committed = True
+                return count
+            pk = list(tbl.primary_key.columns)[0]
+            last = None
+            while True:
+                qo = self._append_wheres(sa.sql.select([pk]), tbl, **kwargs)
+                if last is not None:
+                    qo = qo.where(pk > last)
+                qo = qo.order_by(pk).limit(limit)
+                keys = [x[0] for x in self.session.execute(qo)]
+                if not keys:
+                    break
+                count += self._write_chunk(stmt, stmt.where(pk.in_(keys)))
+                committed = True
+                last = keys[-1]
+                if len(keys) < limit:
+                    break
+            return count
+        finally:
+            if committed:
+                self._notify_write(tbl.name, deleted=count if deletes else 0)
+
+    def _write_chunk(self, stmt, qo):
+        self.session.begin_nested()
+        try:
+            rowcount = self.session.execute(qo).rowcount
+            self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            raise SSimpleDB.Error('{}: {}'.format(
+                stmt.__class__.__name__, e))
+        return rowcount
+
+    def buffered(self, **kwargs):
+        '''Return a SWriteBuffer of this object.'''
+        return SWriteBuffer(self, **kwargs)
+
+    def maintenance(self, **kwargs):
+        '''Return a SMaintenance of this object, which runs the checkpoints
+        and the incremental vacuum instead of the blocking vacuum().'''
+        return SMaintenance(self, **kwargs)
+
+    @_writer
     def upsert_array(self, tablename, **kwargs):
         '''
         param data - If the content of the array had mixed in the 'only_insert'
                      mode, it updates only non-existent data.
+        param bulk - Send the rows as executemany() of 'INSERT ... ON CONFLICT
+                     DO UPDATE' (or 'INSERT OR IGNORE' in the 'only_insert'
+                     mode) in chunks of 'chunk_size' rows.  Values have to be
+                     plain python values, not SQL expressions.
+        param report - Callable for the bulk mode, it is called after each
+                       chunk as report(chunk_index, inserted, updated).
+        The rows of a partitioned table are written to their partitions, and
+        a key in two partitions raises SSimpleDB.Error like upsert().
         '''
+        if tablename in self._partitioned:
+            groups = collections.OrderedDict()
+            for data in kwargs.pop('data'):
+                groups.setdefault(self._route(tablename, data), []).append(
+                    data)
+            routes = {}
+            for pn, rows in groups.items():
+                self._check_keys(tablename, pn, rows, routes)
+            for pn in groups.keys():
+                self.create_partition(tablename, pn)
+            rv = [self.upsert_array(pn, data=rows, **kwargs)
+                  for pn, rows in groups.items()]
+            self._notify_write(tablename)
+            return any(rv)
         tbl = self.get_table(tablename)
         arr_data = kwargs.get('data')
         only_insert = kwargs.get('only_insert', False)
 
+        if kwargs.get('bulk', False):
+            chunk_size = kwargs.get('chunk_size', self.BULK_CHUNK_SIZE)
+            report = kwargs.get('report')
+            return self._bulk_upsert(
+                tbl, arr_data, only_insert, chunk_size, report)
+
         executed_count = 0
+        inserted_count = 0
         self.session.begin_nested()
         for data in arr_data:
-            pk = next(iter(data))
-            pk_column = tbl.c[pk]
-            qc = sa.sql.select([tbl.c[pk]]).where(pk_column == data[pk])
-            qi = sa.insert(tbl).values(**data)
-            qu = sa.update(tbl).values(**data).where(pk_column == data[pk])
             try:
-                item = self.session.query(qc).first()
-                if item is None:
-                    self.session.execute(qi)
-                    executed_count += 1
-                else:
-                    if only_insert:
-                        continue
-                    else:
-                        self.session.execute(qu)
-                        executed_count += 1
+                rv, inserted = self._upsert_row(tbl, data, only_insert)
             except Exception:
                 self.session.rollback()
                 return False
+            executed_count += 1 if rv else 0
+            inserted_count += 1 if inserted else 0
         self.session.commit()
+        self._notify_write(tbl.name, inserted=inserted_count)
         return True if executed_count > 0 else False
 
+    def _bulk_statement(self, tbl, colnames, only_insert):
+        quote = self.engine.dialect.identifier_preparer.quote
+        binds = ['p%d' % i for i in range(len(colnames))]
+        form = {
+            'tn':   quote(tbl.name),
+            'cns':  ','.join([quote(x) for x in colnames]),
+            'vals': ','.join([':' + x for x in binds]),
+            'pk':   quote(colnames[0]),
+            'sets': ','.join(['{c}=excluded.{c}'.format(c=quote(x))
+                              for x in colnames[1:]]),
+        }
+        if only_insert:
+            sql = 'INSERT OR IGNORE INTO {tn} ({cns}) VALUES ({vals})'
+        elif form['sets']:
+            sql = 'INSERT INTO {tn} ({cns}) VALUES ({vals}) ' \
+                  'ON CONFLICT({pk}) DO UPDATE SET {sets}'
+        else:
+            sql = 'INSERT INTO {tn} ({cns}) VALUES ({vals}) ' \
+                  'ON CONFLICT({pk}) DO NOTHING'
+        params = [sa.bindparam(b, type_=tbl.c[c].type)
+                  for b, c in zip(binds, colnames)]
+        return sa.text(sql.format(**form)).bindparams(*params), binds
+
+    def _bulk_chunk(self, tbl, rows, only_insert):
+        '''Upsert one chunk of rows and return (inserted, updated).  Each run
+        of consecutive rows with the same columns is one executemany(), so
+        the rows are written in their order and the last write wins.'''
+        groups = []
+        for data in rows:
+            colnames = tuple(data.keys())
+            if groups and groups[-1][0] == colnames:
+                groups[-1][1].append(data)
+            else:
+                groups.append((colnames, [data]))
+
+        inserted = updated = 0
+        for colnames, group in groups:
+            pk_column = tbl.c[colnames[0]]
+            stmt, binds = self._bulk_statement(tbl, colnames, only_insert)
+            values = [dict(zip(binds, [x[c] for c in colnames]))
+                      for x in group]
+            if only_insert:
+                rv = self.session.execute(stmt, values)
+                inserted += rv.rowcount
+                continue
+            pks = [x[colnames[0]] for x in group]
+            qc = sa.sql.select([pk_column]).where(pk_column.in_(pks))
+            exists = set([x[0] for x in self.session.execute(qc)])
+            for pk in pks:
+                if pk in exists:
+                    updated += 1
+                else:
+                    inserted += 1
+                    exists.add(pk)
+            self.session.execute(stmt, values)
+        return inserted, updated
+
+    def _bulk_upsert(self, tbl, arr_data, only_insert, chunk_size, report):
+        executed_count = 0
+        inserted_count = 0
+        arr_data = list(arr_data)
+        self.session.begin_nested()
+        try:
+            for idx, pos in enumerate(range(0, len(arr_data), chunk_size)):
+                rows = arr_data[pos:pos+chunk_size]
+                inserted, updated = self._bulk_chunk(tbl, rows, only_insert)
+                executed_count += inserted + updated
+                inserted_count += inserted
+                if report:
+                    report(idx, inserted, updated)
+        except Exception:
+            self.session.rollback()
+            return False
+        self.session.commit()
+        self._notify_write(tbl.name, inserted=inserted_count)
+        return True if executed_count > 0 else False
+
+    @_reader
     def query(self, tablename, *args, **kwargs):
+        '''
+        param order - Name of the column to order the rows, optional
+        '''
         size = kwargs.pop(self.SQL_SIZE, self.SQL_V_SIZE)
         page = kwargs.pop(self.SQL_PAGE, self.SQL_V_PAGE)
+        order = kwargs.pop(self.SQL_ORDER, None)
+        rkey = self._result_key('Query', tablename, args, dict(
+            kwargs, **{self.SQL_SIZE: size, self.SQL_PAGE: page,
+                       self.SQL_ORDER: order}))
 
         tbl = self.get_table(tablename)
-        qo = self._build_query(tbl, *args, **kwargs)
-        qo = qo.limit(size)
-        qo = qo.offset(page*size)
+        key, params = self._statement('Query', tbl, *args, **kwargs)
+        parts = self._pruned(tablename, kwargs)
+        key = key + (order, parts and tuple(parts))
+        params.update({'_limit': size, '_offset': page*size})
+        if parts == []:
+            return []
+
+        def build():
+            if parts is None:
+                src = tbl
+                qo = self._build_query(tbl, *args, **kwargs)
+            else:
+                colnames = [x.name for x in self._get_columns(tbl, args)]
+                src = self._union(parts, colnames + [order] if order else
+                                  colnames, **kwargs)
+                qo = sa.sql.select([src.c[x] for x in colnames])
+            if order:
+                qo = qo.order_by(src.c[order])
+            qo = qo.limit(sa.bindparam('_limit', size))
+            qo = qo.offset(sa.bindparam('_offset', page*size))
+            return qo
+
+        return self._cached_result(
+            rkey, lambda: self._execute_cached(key, build, params).fetchall())
+
+    def _pruned(self, tablename, kwargs):
+        '''Return the partitions of the table which the ranges of the
+        partition column select, or None if the table is not partitioned.'''
+        if tablename not in self._partitioned:
+            return None
+        column = self._partitioned[tablename]['partition']['column']
+        start, end = kwargs.get('ranges', {}).get(column, (None, None))
+        return self.partitions(tablename, start, end)
 
+    def _union(self, partitions, colnames, **kwargs):
+        '''Return a subquery of the columns of the partitions, where the
+        wheres are applied to each partition.  Without columns, it selects
+        a constant for the rows to be counted.'''
+        selects = []
+        for pn in partitions:
+            ptbl = self.get_table(pn)
+            qo = sa.sql.select([ptbl.c[x] for x in colnames] or
+                               [sa.literal_column('1')]).select_from(ptbl)
+            selects.append(self._append_wheres(qo, ptbl, **kwargs))
+        if len(selects) == 1:
+            return selects[0].alias()
+        return sa.union_all(*selects).alias()
+
+    def _route(self, tablename, data):
+        '''Return the partition of the row, or the table if it is not
+        partitioned.  The partition is created by create_partition() after
+        the keys of the rows are checked by _check_keys().'''
+        if tablename not in self._partitioned:
+            return tablename
+        column = self._partitioned[tablename]['partition']['column']
+        if data.get(column) is None:
+            emsg = 'Partition {tn}: No Value of {cn}'
+            raise SSimpleDB.Error(emsg.format(tn=tablename, cn=column))
+        return self.partition_of(tablename, data[column])
+
+    def _check_keys(self, tablename, partition, rows, routes=None):
+        '''Raise SSimpleDB.Error if a primary key of the rows is in another
+        partition of the table, the rows do not move between the partitions.
+        param routes - Dict of the keys to the partitions of the rows which
+                       are written together, it is updated with the rows
+        '''
+        if partition == tablename:
+            return
+        emsg = 'Partition {tn}: Key {k} in {pn}, not {p}'
+        pk = list(self.get_table(tablename).primary_key.columns)[0].name
+        keys = [x[pk] for x in rows if x.get(pk) is not None]
+        routes = {} if routes is None else routes
+        for k in keys:
+            if routes.get(k, partition) != partition:
+                raise SSimpleDB.Error(emsg.format(
+                    tn=tablename, k=k, pn=routes[k], p=partition))
+        for pn in self.partitions(tablename):
+            if pn == partition:
+                continue
+            ptbl = self.get_table(pn)
+            for i in range(0, len(keys), self.LOOKUP_CHUNK_SIZE):
+                qo = sa.sql.select([ptbl.c[pk]]).where(ptbl.c[pk].in_(
+                    keys[i:i+self.LOOKUP_CHUNK_SIZE])).limit(1)
+                row = self.session.execute(qo).first()
+                if row is not None:
+                    raise SSimpleDB.Error(emsg.format(
+                        tn=tablename, k=row[0], pn=pn, p=partition))
+        routes.update([(k, partition) for k in keys])
+
+    @_writer
+    def drop_partition(self, tablename, partition):
+        super(SSimpleDB, self).drop_partition(tablename, partition)
+        self.invalidate_table(tablename)
+
+    @_writer
+    def rebuild_summary(self, name):
+        super(SSimpleDB, self).rebuild_summary(name)
+        self._bump_generation(name)
+        self._drop_counts(name)
+
+    @_reader
+    def lookup(self, tablename, colname, values, *args, **kwargs):
+        '''Return the rows whose column equals one of the values, as a dict
+        of the value to the list of its rows.  The values are bound to one
+        IN in chunks of LOOKUP_CHUNK_SIZE, or over LOOKUP_TEMP_SIZE values,
+        written to a temporary key table which is joined in one query.  The
+        wheres of query() filter the rows further.
+        '''
+        parts = self._pruned(tablename, kwargs)
+        if parts is not None:
+            rv = collections.OrderedDict()
+            for pn in parts:
+                found = self.lookup(pn, colname, values, *args, **kwargs)
+                for k, rows in found.items():
+                    rv.setdefault(k, []).extend(rows)
+            return rv
+        tbl = self.get_table(tablename)
+        colnames = [x.name for x in self._get_columns(tbl, args)]
+        extra = colname not in colnames
+        columns = self._get_columns(tbl, colnames + [colname])
+        pos = colnames.index(colname) if not extra else len(colnames)
+        values = list(dict.fromkeys(values))
+
+        if len(values) > self.LOOKUP_TEMP_SIZE:
+            rows = self._lookup_table(tbl, colname, values, columns, **kwargs)
+        else:
+            key, params = self._statement('Lookup', tbl, *args, **kwargs)
+            key = key + (colname,)
+
+            def build():
+                qo = sa.sql.select(columns).where(tbl.c[colname].in_(
+                    sa.bindparam('_keys', expanding=True)))
+                return self._append_wheres(qo, tbl, **kwargs)
+
+            rows = []
+            for i in range(0, len(values), self.LOOKUP_CHUNK_SIZE):
+                params['_keys'] = values[i:i+self.LOOKUP_CHUNK_SIZE]
+                rows += self._execute_cached(key, build, params).fetchall()
+
+        rv = collections.OrderedDict()
+        for row in rows:
+            k = row[pos]
+            rv.setdefault(k, []).append(tuple(row)[:-1] if extra else row)
+        return rv
+
+    def _lookup_table(self, tbl, colname, values, columns, **kwargs):
+        '''The keys are written on a connection of its own in a transaction
+        which is rolled back, so the temporary table never leaves an open
+        transaction on the connection of the session.  The keys are stored
+        as the column type binds them, like DateTime with microseconds.'''
+        with self.engine.connect() as conn:
+            trans = conn.begin()
+            try:
+                conn.execute('CREATE TEMP TABLE IF NOT EXISTS {} '
+                             '(k PRIMARY KEY)'.format(self.LOOKUP_TABLE))
+                sql = sa.text('INSERT OR IGNORE INTO {} (k) VALUES (:k)'
+                              .format(self.LOOKUP_TABLE)).bindparams(
+                    sa.bindparam('k', type_=tbl.c[colname].type))
+                conn.execute(sql, [{'k': x} for x in values])
+                keys = sa.table(self.LOOKUP_TABLE, sa.column('k'))
+                qo = sa.sql.select(columns).select_from(
+                    tbl.join(keys, tbl.c[colname] == keys.c.k))
+                return conn.execute(
+                    self._append_wheres(qo, tbl, **kwargs)).fetchall()
+            finally:
+                trans.rollback()
+
+    @_reader
+    def aggregate(self, tablename, *groups, **kwargs):
+        '''Return a row of each group of the columns, with the group columns
+        and the labels of the aggregates, in the order of the groups.
+        param aggregates - Dict of a label to (function, column), where the
+                           function is one of AGGREGATES, and the column of
+                           'count' is None to count the rows
+        Like query(), the rows are filtered by the wheres.
+        '''
+        aggregates = kwargs.pop('aggregates', {})
+        labels = tuple(sorted(aggregates.items()))
+        tbl = self.get_table(tablename)
+        for func, colname in aggregates.values():
+            if func not in self.AGGREGATES:
+                raise SSimpleDB.Error('Unknown Aggregate: {}'.format(func))
+            if colname is not None and colname not in tbl.c:
+                raise SSimpleDB.Error('Unknown Column: {}'.format(colname))
+        for colname in groups:
+            if colname not in tbl.c:
+                raise SSimpleDB.Error('Unknown Column: {}'.format(colname))
+        if not groups and not aggregates:
+            raise SSimpleDB.Error('Aggregate: No Groups and Aggregates')
+        rkey = self._result_key('Aggregate', tablename, groups,
+                                dict(kwargs, aggregates=labels))
+        key, params = self._statement('Aggregate', tbl, *groups, **kwargs)
+        parts = self._pruned(tablename, kwargs)
+        key = key + (labels, parts and tuple(parts))
+        if parts == []:
+            return []
+
+        def build():
+            src = tbl
+            if parts is not None:
+                colnames = list(groups) + [x[1] for x in aggregates.values()
+                                           if x[1] is not None]
+                src = self._union(parts, list(dict.fromkeys(colnames)),
+                                  **kwargs)
+            columns = [src.c[x] for x in groups]
+            for label, (func, colname) in labels:
+                arg = [] if colname is None else [src.c[colname]]
+                columns.append(self.AGGREGATES[func](*arg).label(label))
+            qo = sa.sql.select(columns).select_from(src)
+            if parts is None:
+                qo = self._append_wheres(qo, tbl, **kwargs)
+            if groups:
+                qo = qo.group_by(*[src.c[x] for x in groups]) \
+                    .order_by(*[src.c[x] for x in groups])
+            return qo
+
+        return self._cached_result(
+            rkey, lambda: self._execute_cached(key, build, params).fetchall())
+
+    def _fetch_batches(self, result, batch):
         try:
-            return self.session.query(qo).all()
-        except Exception:
-            raise SSimpleDB.Error('Query: {}'.format(self.to_sql(qo)))
+            while True:
+                rows = result.fetchmany(batch)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            result.close()
+
+    def _get_dictable(self, tablename):
+        for dictable in self.config.get_value('tables'):
+            if dictable['name'] == tablename:
+                return dictable
+        raise SSimpleDB.Error('Not Exists Table in Config: {}'.format(
+            tablename))
+
+    def _converters(self, tablename):
+        '''Return the functions, which convert a text or JSON value to the type
+        of each column in the config.'''
+        def boolean(v):
+            if isinstance(v, str):
+                return v.strip().lower() in ['1', 'true', 'yes', 'on']
+            return bool(v)
+
+        def datetime_(v):
+            if isinstance(v, datetime.datetime):
+                return v
+            text = str(v).strip().replace('T', ' ')
+            fmt = '%Y-%m-%d %H:%M:%S.%f' if '.' in text else \
+                '%Y-%m-%d %H:%M:%S'
+            return datetime.datetime.strptime(text, fmt)
+
+        def date_(v):
+            if isinstance(v, datetime.date):
+                return v
+            return datetime.datetime.strptime(str(v).strip()[:10],
+                                              '%Y-%m-%d').date()
+
+        types = {
+            'Boolean':  boolean,
+            'DateTime': datetime_,
+            'Float':    float,
+            'Integer':  int,
+            'Date':     date_,
+        }
+        converters = {}
+        for colparam in self._get_dictable(tablename)['columns']:
+            converters[colparam[0]] = types.get(colparam[1], str)
+        return converters
+
+    def _is_scsv(self, rows):
+        '''A file of SCSV starts with the title and the stamp rows, whose other
+        cells are empty, and the header of an empty index cell.'''
+        if len(rows) < 3 or not rows[2] or rows[2][0] != '':
+            return False
+        width = len(rows[2]) - 1
+        return all([len(x) == width and not any(x[1:]) for x in rows[:2]])
+
+    def _read_csv(self, fd, colnames, scsv=None):
+        '''Yield rows of a CSV file as dictionaries.  A file of SCSV, which is
+        given by 'scsv' or detected from its layout, is read after its title
+        and stamp rows, and its '="..."' values are unquoted and 'None' is
+        None as SCSV writes it.'''
+        reader = csv.reader(fd)
+        head = list(itertools.islice(reader, 3))
+        if scsv is None:
+            scsv = self._is_scsv(head)
+        if scsv:
+            if not self._is_scsv(head):
+                raise SSimpleDB.Error('Not SCSV Layout')
+            header, head = head[2][1:], []
+        else:
+            header, head = (head[0], head[1:]) if head else ([], [])
+        unknown = [x for x in header if x not in colnames]
+        if unknown:
+            raise SSimpleDB.Error('Unknown Columns: {}'.format(
+                ', '.join(unknown)))
+        skip = 1 if scsv else 0
+        for row in itertools.chain(head, reader):
+            values = []
+            for v in row[skip:]:
+                m = self.RE_SCSV_STR.match(v)
+                v = m.group(1) if m else v
+                values.append(None if scsv and v == 'None' else v)
+            yield dict(zip(header, values))
+
+    def _read_jsonl(self, fd, colnames):
+        for lineno, line in enumerate(fd, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            unknown = [x for x in item.keys() if x not in colnames]
+            if unknown:
+                raise SSimpleDB.Error('Unknown Columns: {} (line {})'.format(
+                    ', '.join(unknown), lineno))
+            yield item
+
+    def import_file(self, tablename, path, **kwargs):
+        '''Import a CSV (also written by SCSV) or a JSON Lines file to the
+        table, the values are converted to the types of the columns in the
+        config and written by the bulk upsert_array() in batches.
+        param format - 'csv', 'scsv' or 'jsonl', it is guessed by the
+                       extension, and a 'csv' file in the layout of SCSV is
+                       read as 'scsv'.  The empty and 'None' values of the
+                       columns other than String are None.  A CSV header or
+                       a JSON key which is not a column raises
+                       SSimpleDB.Error.
+        param batch - Number of rows per upsert_array()
+        param only_insert - Passed to upsert_array()
+        param progress - Callable, it is called after each batch as
+                         progress(rows, written)
+        '''
+        fmt = kwargs.get('format')
+        batch = kwargs.get(self.SQL_BATCH, self.SQL_V_BATCH)
+        only_insert = kwargs.get('only_insert', False)
+        progress = kwargs.get('progress')
+        if fmt is None:
+            fmt = 'jsonl' if path.split('.')[-1] in ['jsonl', 'json'] \
+                else 'csv'
+        readers = {
+            'csv':      self._read_csv,
+            'scsv':     functools.partial(self._read_csv, scsv=True),
+            'jsonl':    self._read_jsonl,
+        }
+        if fmt not in readers:
+            raise SSimpleDB.Error('Unknown Format: {}'.format(fmt))
 
-    def count(self, tablename, *args, **kwargs):
         tbl = self.get_table(tablename)
-        qo = self._build_query(tbl, *args, **kwargs)
+        pk = list(tbl.primary_key.columns)[0].name
+        converters = self._converters(tablename)
+        stats = {'rows': 0, 'written': 0}
+
+        def report(idx, inserted, updated):
+            stats['written'] += inserted + updated
+
+        def write(rows):
+            rv = self.upsert_array(tablename, data=rows, bulk=True,
+                                   only_insert=only_insert, report=report)
+            if not rv and not only_insert:
+                emsg = 'Import {}: Failed after row {}'.format(
+                    path, stats['rows'] - len(rows))
+                raise SSimpleDB.Error(emsg)
+            if progress:
+                progress(stats['rows'], stats['written'])
+
+        started = time.time()
+        with open(path, 'r', encoding='utf-8', newline='') as fd:
+            rows = []
+            for item in readers[fmt](fd, converters.keys()):
+                data = {pk: None}
+                for k, v in item.items():
+                    if v is None or (converters[k] is not str and
+                                     v in ['', 'None']):
+                        data[k] = None
+                    else:
+                        data[k] = converters[k](v)
+                rows.append(data)
+                stats['rows'] += 1
+                if len(rows) >= batch:
+                    write(rows)
+                    rows = []
+            if rows:
+                write(rows)
+
+        seconds = max(time.time() - started, 1e-6)
+        stats['seconds'] = seconds
+        stats['rows_per_sec'] = stats['rows'] / seconds
+        return stats
+
+    def _iter_statement(self, tbl, *args, **kwargs):
+        '''The rows of a partitioned table are read from its partitions, or
+        from the empty template if no partition is in the ranges.'''
+        key, params = self._statement('Query', tbl, *args, **kwargs)
+        parts = self._pruned(tbl.name, kwargs) or None
+        key = key + ('iter', parts and tuple(parts))
+
+        def build():
+            if parts is None:
+                return self._build_query(tbl, *args, **kwargs)
+            colnames = [x.name for x in self._get_columns(tbl, args)]
+            src = self._union(parts, colnames, **kwargs)
+            return sa.sql.select([src.c[x] for x in colnames])
+
+        return key, build, params
+
+    def iter_query(self, tablename, *args, **kwargs):
+        '''Yield all rows of the query, which are read from one cursor in
+        batches of 'batch' rows.  It takes the arguments of query() except the
+        page and size.'''
+        batch = kwargs.pop(self.SQL_BATCH, self.SQL_V_BATCH)
+        kwargs.pop(self.SQL_PAGE, None)
+        kwargs.pop(self.SQL_SIZE, None)
+
+        tbl = self.get_table(tablename)
+        key, build, params = self._iter_statement(tbl, *args, **kwargs)
+        try:
+            result = self._execute_cached(key, build, params)
+            for rows in self._fetch_batches(result, batch):
+                for row in rows:
+                    yield row
+        finally:
+            self._release()
+
+    def export_csv(self, path, title, tablename, *args, **kwargs):
+        '''Write the rows of the query to a SCSV file, it is split by
+        SCSV.MAX_FIELD_COUNT.  The rows are read on a producer thread with its
+        own connection, and handed over in batches through a queue of
+        'queue_size' batches.  It takes the arguments of iter_query() and
+        'to_str' of SCSV.write_field(), and returns the statistics.'''
+        batch = kwargs.pop(self.SQL_BATCH, self.SQL_V_BATCH)
+        queue_size = kwargs.pop('queue_size', self.EXPORT_QUEUE_SIZE)
+        to_str = kwargs.pop('to_str', False)
+        kwargs.pop(self.SQL_PAGE, None)
+        kwargs.pop(self.SQL_SIZE, None)
+
+        tbl = self.get_table(tablename)
+        colnames = [x.name for x in self._get_columns(tbl, args)]
+        key, build, params = self._iter_statement(tbl, *args, **kwargs)
+        rowq = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    rowq.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def produce():
+            try:
+                with self.engine.connect() as conn:
+                    result = self._execute_cached(key, build, params, conn)
+                    for rows in self._fetch_batches(result, batch):
+                        put(rows)
+                        if stop.is_set():
+                            break
+                put(None)
+            except Exception as e:
+                put(e)
+
+        started = time.time()
+        count = 0
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        scsv = SCSV(path, title, colnames)
         try:
-            return self.session.query(qo).count()
+            while True:
+                rows = rowq.get()
+                if rows is None:
+                    break
+                if isinstance(rows, Exception):
+                    raise rows
+                for row in rows:
+                    scsv.write_field(list(row), to_str=to_str)
+                count += len(rows)
+        finally:
+            stop.set()
+            producer.join()
+            scsv.close()
+
+        seconds = max(time.time() - started, 1e-6)
+        stats = {
+            'rows':         count,
+            'files':        scsv.split_index + 1,
+            'seconds':      seconds,
+            'rows_per_sec': count / seconds,
+        }
+        self.dprint('Export {tn}: {r} rows, {s:.3f} sec, {rps:.1f} rows/s'
+                    .format(tn=tablename, r=count, s=seconds,
+                            rps=stats['rows_per_sec']))
+        return stats
+
+    def encode_cursor(self, values):
+        def encode(v):
+            if isinstance(v, datetime.datetime):
+                return {'dt': v.isoformat()}
+            if isinstance(v, datetime.date):
+                return {'d': v.isoformat()}
+            return v
+        text = json.dumps([encode(v) for v in values])
+        return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        def decode(v):
+            if isinstance(v, dict) and 'dt' in v:
+                fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in v['dt'] \
+                    else '%Y-%m-%dT%H:%M:%S'
+                return datetime.datetime.strptime(v['dt'], fmt)
+            if isinstance(v, dict) and 'd' in v:
+                return datetime.datetime.strptime(v['d'], '%Y-%m-%d').date()
+            return v
+        try:
+            text = base64.urlsafe_b64decode(cursor.encode('ascii'))
+            return [decode(v) for v in json.loads(text.decode('utf-8'))]
         except Exception:
-            raise SSimpleDB.Error('Count: {}'.format(self.to_sql(qo)))
+            raise SSimpleDB.Error('Invalid Cursor: {}'.format(cursor))
+
+    @_reader
+    def query_keyset(self, tablename, *args, **kwargs):
+        '''Query a page after the 'cursor' which the previous call returned,
+        the result is a tuple of (rows, next_cursor).  The next_cursor is None
+        on the last page.  Rows are ordered by the 'order' column and the
+        primary key, so the order column should not have NULL values.
+        '''
+        size = kwargs.pop(self.SQL_SIZE, self.SQL_V_SIZE)
+        cursor = kwargs.pop(self.SQL_CURSOR, None)
+        order = kwargs.pop(self.SQL_ORDER, None)
+
+        tbl = self.get_table(tablename)
+        pks = list(tbl.primary_key.columns)
+        if len(pks) != 1:
+            emsg = 'Keyset Query: Need a Primary Key - {}'.format(tablename)
+            raise SSimpleDB.Error(emsg)
+        keys = pks if order in [None, pks[0].name] else [tbl.c[order], pks[0]]
 
+        columns = list(self._get_columns(tbl, args))
+        extras = [x for x in keys if x not in columns]
+        positions = [(columns + extras).index(x) for x in keys]
+        key, params = self._statement('Query', tbl, *args, **kwargs)
+        parts = self._pruned(tablename, kwargs) or None
+        key = key + ('keyset', order, bool(cursor), parts and tuple(parts))
+        params['_limit'] = size
+        if cursor:
+            values = self.decode_cursor(cursor)
+            for i, v in enumerate(values):
+                params['_k{}'.format(i)] = v
+
+        def build():
+            colnames = [x.name for x in columns + extras]
+            if parts is None:
+                src = tbl
+                qo = sa.sql.select(columns + extras)
+                qo = self._append_wheres(qo, tbl, **kwargs)
+            else:
+                src = self._union(parts, colnames, **kwargs)
+                qo = sa.sql.select([src.c[x] for x in colnames])
+            skeys = [src.c[x.name] for x in keys]
+            if cursor:
+                binds = [sa.bindparam('_k{}'.format(i), v, type_=x.type)
+                         for i, (x, v) in enumerate(zip(keys, values))]
+                if len(keys) == 1:
+                    qo = qo.where(skeys[0] > binds[0])
+                else:
+                    qo = qo.where(sa.tuple_(*skeys) > sa.tuple_(*binds))
+            return qo.order_by(*skeys).limit(sa.bindparam('_limit', size))
+
+        rows = self._execute_cached(key, build, params).fetchall()
+        next_cursor = None
+        if len(rows) == size:
+            next_cursor = self.encode_cursor([rows[-1][x] for x in positions])
+        if extras:
+            rows = [tuple(x)[:len(columns)] for x in rows]
+        return rows, next_cursor
+
+    def _notify_write(self, tablename, inserted=0, deleted=0):
+        '''It is called after a write to the table was committed.'''
+        self._bump_generation(tablename)
+        for name, summary in self._summaries.items():
+            if summary[0] == tablename:
+                self._bump_generation(name)
+                self._drop_counts(name)
+        with self._count_lock:
+            for key, entry in self._counts.items():
+                if key[1] != tablename:
+                    continue
+                if not key[3][1]:
+                    entry[0] += inserted - deleted
+                entry[2] = True
+
+    def _approximate_count(self, key, build, params):
+        with self._count_lock:
+            entry = self._counts.get(key)
+            if entry is not None:
+                age = time.time() - entry[1]
+                if not entry[2] or age < self.APPROX_COUNT_TTL:
+                    return entry[0]
+        value = self._execute_cached(key, build, params).scalar()
+        with self._count_lock:
+            self._counts[key] = [value, time.time(), False]
+        return value
+
+    @_reader
+    def count(self, tablename, *args, **kwargs):
+        '''Count rows with the wheres, the columns are not used.
+        param approximate - Return the counter which is kept from the last
+                            count.  The unfiltered counter follows the inserts
+                            and deletes of this object between the counts.
+                            Each counter is counted again if it is older than
+                            APPROX_COUNT_TTL seconds after a write to the
+                            table.
+        '''
+        parts = self._pruned(tablename, kwargs)
+        if parts is not None:
+            return sum([self.count(pn, **kwargs) for pn in parts])
+        approximate = kwargs.pop('approximate', False)
+        rkey = self._result_key('Count', tablename, (), kwargs)
+        tbl = self.get_table(tablename)
+        key, params = self._statement('Count', tbl, **kwargs)
+
+        def build():
+            qo = sa.sql.select([sa.func.count()]).select_from(tbl)
+            return self._append_wheres(qo, tbl, **kwargs)
+
+        if approximate:
+            return self._approximate_count(key, build, params)
+        return self._cached_result(
+            rkey, lambda: self._execute_cached(key, build, params).scalar())
+
+    @_writer
     def vacuum(self):
         if self.session.bind.dialect.name == 'sqlite':
             self.session.execute('VACUUM')
+            for tablename in self._fulltext.keys():
+                self.rebuild_fulltext(tablename)
             return
         raise SSimpleDB.Error('Not Implemented to VACCUM')
+
+
+class SWriteBuffer(object):
+    '''Write-behind buffer of SSimpleDB.upsert.  The queued upserts are written
+    in one transaction, when 'max_rows' upserts are queued or the oldest one
+    waited 'max_delay' seconds.  Each upsert gets a Future of the result of
+    SSimpleDB.upsert(), or of the exception of the failed write.
+
+    The delay is watched by a background thread on a threadsafe SSimpleDB, or
+    else checked on each upsert().
+    '''
+    MAX_ROWS = 500
+    MAX_DELAY = 0.5
+
+    def __init__(self, db, **kwargs):
+        self.db = db
+        self.max_rows = kwargs.get('max_rows', self.MAX_ROWS)
+        self.max_delay = kwargs.get('max_delay', self.MAX_DELAY)
+        self._items = []
+        self._first = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = None
+        if db.threadsafe:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def upsert(self, tablename, **kwargs):
+        '''Queue an upsert, it takes the arguments of SSimpleDB.upsert() and
+        an optional 'callback' which is called with the Future when done.'''
+        future = Future()
+        callback = kwargs.pop('callback', None)
+        if callback:
+            future.add_done_callback(callback)
+        with self._cond:
+            if self._closed:
+                raise SSimpleDB.Error('Write Buffer: Already Closed')
+            self._items.append((tablename, kwargs, future))
+            if self._first is None:
+                self._first = time.time()
+            full = len(self._items) >= self.max_rows
+            late = time.time() - self._first >= self.max_delay
+            self._cond.notify()
+        if full or (self._thread is None and late):
+            self.flush()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and self._first is None:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                timeout = self._first + self.max_delay - time.time()
+                if timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+            self.flush()
+
+    def flush(self):
+        '''Write the queued upserts in one transaction.'''
+        db = self.db
+        inserted = collections.Counter()
+        results = []
+        with db._write_lock:
+            # The queue is taken under the lock of the write, so the batches
+            # are committed in the order of the upserts.
+            with self._cond:
+                items, self._items = self._items, []
+                self._first = None
+            if not items:
+                return
+            # The partitions are created before the transaction of the rows.
+            routes = []
+            keys = collections.defaultdict(dict)
+            for tablename, kwargs, future in items:
+                data = kwargs.get('data')
+                try:
+                    partition = db._route(tablename, data)
+                    if partition != tablename:
+                        db._check_keys(tablename, partition, [data],
+                                       keys[tablename])
+                        db.create_partition(tablename, partition)
+                    routes.append(partition)
+                except Exception as e:
+                    routes.append(e)
+            try:
+                db.session.begin_nested()
+                for (tablename, kwargs, future), partition in zip(items,
+                                                                  routes):
+                    if isinstance(partition, Exception):
+                        results.append((future, None, partition))
+                        continue
+                    db.session.begin_nested()
+                    try:
+                        tbl = db.get_table(partition)
+                        rv, ins = db._upsert_row(
+                            tbl, kwargs.get('data'),
+                            kwargs.get('only_insert', False))
+                        db.session.commit()
+                        inserted[partition] += 1 if ins else 0
+                        results.append((future, rv, None))
+                    except Exception as e:
+                        db.session.rollback()
+                        results.append((future, None, e))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                for tablename, kwargs, future in items:
+                    future.set_exception(e)
+                return
+            finally:
+                db._release()
+        for tablename, count in inserted.items():
+            db._notify_write(tablename, inserted=count)
+        for tablename in set([x[0] for x in items]) & set(db._partitioned):
+            db._notify_write(tablename)
+        for future, rv, e in results:
+            if e is None:
+                future.set_result(rv)
+            else:
+                future.set_exception(e)
+
+    def close(self):
+        '''Flush the queued upserts and stop the buffer.'''
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+
+class SMaintenance(object):
+    '''Background maintenance of a SSimpleDB in the WAL mode.  Every
+    'interval' seconds, it checks the size of the '-wal' file and runs a
+    PASSIVE checkpoint over 'wal_size' bytes or a TRUNCATE one over
+    'truncate_size' bytes, and with 'auto_vacuum=INCREMENTAL' it frees up to
+    'vacuum_pages' pages of the freelist.
+
+    It works on its own connection, so the reads of the foreground are not
+    blocked.  The TRUNCATE checkpoint and the incremental vacuum write the
+    database, and wait for the write lock of the SSimpleDB.
+    '''
+    INTERVAL = 10.0
+    WAL_SIZE = 4 * 1024 * 1024
+    TRUNCATE_SIZE = 64 * 1024 * 1024
+    VACUUM_PAGES = 1000
+
+    def __init__(self, db, **kwargs):
+        self.db = db
+        self.interval = kwargs.get('interval', self.INTERVAL)
+        self.wal_size = kwargs.get('wal_size', self.WAL_SIZE)
+        self.truncate_size = kwargs.get('truncate_size', self.TRUNCATE_SIZE)
+        self.vacuum_pages = kwargs.get('vacuum_pages', self.VACUUM_PAGES)
+        self.stats = collections.Counter()
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def wal_bytes(self):
+        try:
+            return os.path.getsize(self.db.dbpath + '-wal')
+        except OSError:
+            return 0
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                self.last_error = e
+                self.stats['errors'] += 1
+
+    def run_once(self):
+        '''Run one step of the maintenance, and return the stats.'''
+        conn = self.db.engine.connect()
+        try:
+            if conn.execute('PRAGMA auto_vacuum').scalar() == 2:
+                free = conn.execute('PRAGMA freelist_count').scalar()
+                if free:
+                    # pysqlite steps the pragma once, which frees one page.
+                    with self.db._write_lock:
+                        conn.connection.executescript(
+                            'PRAGMA incremental_vacuum({})'.format(
+                                self.vacuum_pages))
+                    self.stats['vacuumed_pages'] += \
+                        free - conn.execute('PRAGMA freelist_count').scalar()
+            size = self.wal_bytes()
+            if size >= self.truncate_size:
+                with self.db._write_lock:
+                    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+                self.stats['truncates'] += 1
+            elif size >= self.wal_size:
+                conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+                self.stats['checkpoints'] += 1
+            self.stats['runs'] += 1
+        finally:
+            conn.close()
+        return self.stats
+
+    def close(self):
+        '''Stop the background thread.'''
+        self._stop.set()
+        self._thread.join()
+
+
+class SQueryStats(object):
+    '''Timings of the statements of an engine by the calling API of
+    SSimpleDB, such as query, count or upsert, in histograms of BUCKETS
+    seconds.  The rows are the rows written by the statements and returned
+    by the API.  A statement over 'slow_query' seconds is kept in
+    'slow_queries' with its EXPLAIN QUERY PLAN, logged, and appended to the
+    'slow_query_log' file as a JSON line.
+    '''
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+    SLOW_QUERY_KEEP = 100
+    OTHER = 'other'
+
+    def __init__(self, slow_query=None, slow_query_log=None):
+        self.slow_query = slow_query
+        self.slow_query_log = slow_query_log
+        self.local = threading.local()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._apis = {}
+            self.slow_queries = collections.deque(
+                maxlen=self.SLOW_QUERY_KEEP)
+
+    def attach(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _entry(self, api):
+        entry = self._apis.get(api)
+        if entry is None:
+            entry = self._apis[api] = {
+                'count': 0, 'seconds': 0.0, 'max': 0.0, 'rows': 0,
+                'buckets': [0] * (len(self.BUCKETS) + 1)}
+        return entry
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        conn.info.setdefault('pysp_started', []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        seconds = time.perf_counter() - conn.info['pysp_started'].pop()
+        api = getattr(self.local, 'api', None) or self.OTHER
+        rows = max(cursor.rowcount, 0)
+        with self._lock:
+            entry = self._entry(api)
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            entry['rows'] += rows
+            entry['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        if self.slow_query is not None and seconds >= self.slow_query:
+            params = parameters[0] if executemany else parameters
+            self._log_slow(cursor.connection, api, statement, params,
+                           seconds, rows)
+
+    def _log_slow(self, dbapi_connection, api, statement, params, seconds,
+                  rows):
+        plan = None
+        if re.match(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', statement,
+                    re.IGNORECASE):
+            explain = dbapi_connection.cursor()
+            try:
+                explain.execute('EXPLAIN QUERY PLAN ' + statement, params)
+                plan = [x[-1] for x in explain.fetchall()]
+            except Exception:
+                pass
+            finally:
+                explain.close()
+        entry = {'time': time.time(), 'api': api, 'seconds': seconds,
+                 'rows': rows, 'statement': statement, 'plan': plan}
+        with self._lock:
+            self.slow_queries.append(entry)
+            if self.slow_query_log:
+                with open(self.slow_query_log, 'a') as fd:
+                    fd.write(json.dumps(entry, default=str) + '\n')
+        SDebug().iprint('Slow Query: {} {:.3f}s {}'.format(
+            api, seconds, ' '.join(statement.split())))
+
+    def add_rows(self, api, rows):
+        with self._lock:
+            self._entry(api)['rows'] += rows
+
+    def snapshot(self):
+        '''Return the stats of every API, where the buckets are keyed by
+        their upper bound in seconds.'''
+        bounds = [str(x) for x in self.BUCKETS] + ['inf']
+        with self._lock:
+            return {api: dict(entry, buckets=dict(zip(bounds,
+                                                      entry['buckets'])))
+                    for api, entry in self._apis.items()}
+
+
+class SShardedDB(object):
+    '''SSimpleDB partitioned by the primary key across several database files
+    with one config.  The rows are placed by the hash of the primary key, or
+    by 'bounds' of the primary key in the 'range' partition, where a row goes
+    to the first shard whose bound is greater than its key.  Like upsert(),
+    the first key of a data is the primary key.  query() and count() run on
+    all shards in parallel and merge the results in the primary key order.
+    '''
+    PART_HASH = 'hash'
+    PART_RANGE = 'range'
+
+    def __init__(self, dbpaths, config, **kwargs):
+        self.partition = kwargs.pop('partition', self.PART_HASH)
+        self.bounds = list(kwargs.pop('bounds', []))
+        if self.partition == self.PART_RANGE and \
+                len(self.bounds) != len(dbpaths) - 1:
+            raise SSimpleDB.Error('Sharded: Need {} Bounds'.format(
+                len(dbpaths) - 1))
+        if self.partition not in [self.PART_HASH, self.PART_RANGE]:
+            raise SSimpleDB.Error('Sharded: Unknown Partition - {}'.format(
+                self.partition))
+        kwargs['threadsafe'] = True
+        # Every shard migrates its own file, so they get a copy of the config
+        # before the first one removes the 'migrate' of the config.
+        configs = [config] + [copy.deepcopy(config) for x in dbpaths[1:]]
+        self.shards = [SSimpleDB(path, cfg, **kwargs)
+                       for path, cfg in zip(dbpaths, configs)]
+        self.executor = ThreadPoolExecutor(max_workers=len(self.shards))
+
+    def close(self):
+        self.executor.shutdown()
+        for shard in self.shards:
+            shard.engine.dispose()
+
+    def shard_of(self, pk):
+        if self.partition == self.PART_RANGE:
+            return bisect.bisect_right(self.bounds, pk)
+        return zlib.crc32(str(pk).encode('utf-8')) % len(self.shards)
+
+    def _fan_out(self, method, *args, **kwargs):
+        futures = [self.executor.submit(getattr(x, method), *args, **kwargs)
+                   for x in self.shards]
+        return [x.result() for x in futures]
+
+    def get_colnames(self, tablename):
+        return self.shards[0].get_colnames(tablename)
+
+    def upsert(self, tablename, **kwargs):
+        pk = next(iter(kwargs['data'].values()))
+        return self.shards[self.shard_of(pk)].upsert(tablename, **kwargs)
+
+    def upsert_array(self, tablename, **kwargs):
+        groups = collections.defaultdict(list)
+        for data in kwargs.pop('data'):
+            groups[self.shard_of(next(iter(data.values())))].append(data)
+        futures = []
+        for idx, rows in groups.items():
+            futures.append(self.executor.submit(
+                self.shards[idx].upsert_array, tablename, data=rows,
+                **kwargs))
+        return any([x.result() for x in futures])
+
+    def query(self, tablename, *args, **kwargs):
+        '''Query the first (page+1)*size rows of each shard in the primary
+        key order, and return the page of the merged rows.'''
+        size = kwargs.pop(SSimpleDB.SQL_SIZE, SSimpleDB.SQL_V_SIZE)
+        page = kwargs.pop(SSimpleDB.SQL_PAGE, SSimpleDB.SQL_V_PAGE)
+        tbl = self.shards[0].get_table(tablename)
+        pk = list(tbl.primary_key.columns)[0].name
+        colnames = [x.name for x in self.shards[0]._get_columns(tbl, args)]
+        extra = pk not in colnames
+        pos = len(colnames) if extra else colnames.index(pk)
+        kwargs.update({
+            SSimpleDB.SQL_SIZE:     (page + 1) * size,
+            SSimpleDB.SQL_PAGE:     0,
+            SSimpleDB.SQL_ORDER:    pk,
+        })
+        results = self._fan_out('query', tablename,
+                                *(colnames + ([pk] if extra else [])),
+                                **kwargs)
+        merged = heapq.merge(*results, key=lambda x: x[pos])
+        rows = list(itertools.islice(merged, page * size, (page + 1) * size))
+        if extra:
+            rows = [tuple(x)[:-1] for x in rows]
+        return rows
+
+    def count(self, tablename, *args, **kwargs):
+        return sum(self._fan_out('count', tablename, *args, **kwargs))
+
+    def update_where(self, tablename, values, **kwargs):
+        return sum(self._fan_out('update_where', tablename, values, **kwargs))
+
+    def delete_where(self, tablename, **kwargs):
+        return sum(self._fan_out('delete_where', tablename, **kwargs))
+
+    def vacuum(self):
+        self._fan_out('vacuum')
+
+
+class SAsyncSimpleDB(object):
+    '''asyncio front-end of SSimpleDB.  The calls run on a bounded executor
+    over a threadsafe SSimpleDB, which has its own pool of connections.'''
+    MAX_WORKERS = 4
+
+    def __init__(self, dbpath, config, **kwargs):
+        self.max_workers = kwargs.pop('max_workers', self.MAX_WORKERS)
+        kwargs['threadsafe'] = True
+        kwargs.setdefault('pool_size', self.max_workers)
+        self.db = SSimpleDB(dbpath, config, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        call = functools.partial(func, *args, **kwargs)
+        return await loop.run_in_executor(self.executor, call)
+
+    async def query(self, tablename, *args, **kwargs):
+        return await self._run(self.db.query, tablename, *args, **kwargs)
+
+    async def count(self, tablename, *args, **kwargs):
+        return await self._run(self.db.count, tablename, *args, **kwargs)
+
+    async def upsert(self, tablename, **kwargs):
+        return await self._run(self.db.upsert, tablename, **kwargs)
+
+    async def upsert_array(self, tablename, **kwargs):
+        return await self._run(self.db.upsert_array, tablename, **kwargs)
+
+    async def vacuum(self):
+        return await self._run(self.db.vacuum)
+
+    async def close(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.executor.shutdown)
+        self.db.engine.dispose()
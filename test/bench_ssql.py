@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+'''Benchmarks of the SSimpleDB data path.
+
+    python -m test.bench_ssql threads --rows 100000 --threads 1,2,4,8
+    python -m test.bench_ssql profiles --rows 100000
+    python -m test.bench_ssql suite --sizes 1000,10000,100000 \\
+        --output bench.json --baseline baseline.json
+'''
+import argparse
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+from pysp.sbasic import SFile
+from pysp.sconf import SConfig
+from pysp.ssql import SSimpleDB
+
+
+BENCH_FOLDER = '/tmp/sql-bench/'
+BENCH_CONFIG = '''
+tables:
+    - name: bench
+      columns:
+        - [Key, Integer, PrimaryKey]
+        - [Name, String20]
+        - [Value, Float]
+'''
+SUITE_SIZES = '1000,10000,100000,1000000,10000000'
+SUITE_CHUNK = 100000
+
+
+def make_schema(columns=0, rename=False):
+    '''Return the YAML of the bench table with extra String columns.  The
+    rename one migrates the Name column into Title.'''
+    lines = BENCH_CONFIG.rstrip().split('\n')
+    if rename:
+        lines = [x.replace('[Name,', '[Title,') for x in lines]
+    lines += ['        - [C%d, String20]' % i for i in range(columns)]
+    if rename:
+        lines += ['      migrate:',
+                  '        operation: rename',
+                  '        columns:',
+                  '            Title: Name']
+    return '\n'.join(lines) + '\n'
+
+
+def open_db(folder, columns=0, clean=True, rename=False, **kwargs):
+    if clean and os.path.exists(folder):
+        shutil.rmtree(folder)
+    SFile.to_file(folder+'db.cfg', make_schema(columns, rename))
+    return SSimpleDB(folder+'bench.sqlite3', SConfig(folder+'db.cfg'),
+                     **kwargs)
+
+
+def make_rows(start, count, columns=0):
+    rows = [{'Key': i, 'Name': 'n%d' % (i % 100), 'Value': float(i)}
+            for i in range(start, start + count)]
+    for i in range(columns):
+        name = 'C%d' % i
+        for row in rows:
+            row[name] = 'c%d' % (row['Key'] % 1000)
+    return rows
+
+
+def fill(db, rows):
+    db.upsert_array('bench', data=make_rows(0, rows), bulk=True)
+
+
+def bench_threads(db, rows, threads, seconds):
+    '''Run point reads from the given number of threads for some seconds
+    and return the total reads per second.'''
+    counts = [0] * threads
+    stop = threading.Event()
+
+    def reader(idx):
+        key = idx
+        while not stop.is_set():
+            db.query('bench', wheres={'Key': key % rows}, size=1)
+            key += threads
+            counts[idx] += 1
+
+    workers = [threading.Thread(target=reader, args=(i,))
+               for i in range(threads)]
+    for w in workers:
+        w.start()
+    time.sleep(seconds)
+    stop.set()
+    for w in workers:
+        w.join()
+    return sum(counts) / seconds
+
+
+def bench_profile(folder, profile, rows, upserts, queries):
+    '''Return the throughput of bulk ingest, single upserts and paged queries
+    under the profile.'''
+    db = open_db(folder, profile=profile)
+    result = {}
+
+    started = time.time()
+    fill(db, rows)
+    result['bulk rows/s'] = rows / (time.time() - started)
+
+    started = time.time()
+    for data in make_rows(rows, upserts):
+        db.upsert('bench', data=data)
+    result['upserts/s'] = upserts / (time.time() - started)
+
+    started = time.time()
+    for i in range(queries):
+        db.query('bench', wheres={'Name': 'n%d' % (i % 100)}, size=20,
+                 page=i % 10)
+    result['queries/s'] = queries / (time.time() - started)
+    del db
+    return result
+
+
+def bench_suite(folder, rows, columns, upserts, queries):
+    '''Return the rates of the data path over a table of the rows, where a
+    higher rate is better for every entry.'''
+    db = open_db(folder, columns)
+    result = {}
+
+    started = time.time()
+    for start in range(0, rows, SUITE_CHUNK):
+        db.upsert_array('bench', bulk=True, data=make_rows(
+            start, min(SUITE_CHUNK, rows - start), columns))
+    result['upsert_array rows/s'] = rows / (time.time() - started)
+
+    started = time.time()
+    for data in make_rows(0, upserts, columns):
+        data['Key'] = (data['Key'] * 7919) % rows
+        db.upsert('bench', data=data)
+    result['upsert/s'] = upserts / (time.time() - started)
+
+    pages = max(1, rows // (20 * 100))
+    started = time.time()
+    for i in range(queries):
+        db.query('bench', wheres={'Name': 'n%d' % (i % 100)}, size=20,
+                 page=i % pages)
+    result['query/s'] = queries / (time.time() - started)
+
+    started = time.time()
+    for i in range(queries):
+        db.count('bench', wheres={'Name': 'n%d' % (i % 100)})
+    result['count/s'] = queries / (time.time() - started)
+    del db
+
+    started = time.time()
+    db = open_db(folder, columns, clean=False)
+    result['init_tables/s'] = 1 / (time.time() - started)
+    del db
+
+    started = time.time()
+    db = open_db(folder, columns, clean=False, rename=True)
+    result['migrate rows/s'] = rows / (time.time() - started)
+    del db
+    return result
+
+
+def compare(baseline, results, threshold):
+    '''Return the (size, title, baseline, current) entries whose rate fell
+    by more than the threshold ratio from the baseline.'''
+    regressions = []
+    for size, entries in results.items():
+        for title, rate in entries.items():
+            base = baseline.get(size, {}).get(title)
+            if base and rate < base * (1 - threshold):
+                regressions.append((size, title, base, rate))
+    return regressions
+
+
+def run_threads(args):
+    threads = [int(x) for x in args.threads.split(',')]
+    db = open_db(args.folder, threadsafe=True, pool_size=max(threads))
+    fill(db, args.rows)
+    print('{:>8} {:>12}'.format('threads', 'reads/s'))
+    for t in threads:
+        rps = bench_threads(db, args.rows, t, args.seconds)
+        print('{:>8} {:>12.1f}'.format(t, rps))
+    del db
+
+
+def run_profiles(args):
+    profiles = args.profiles.split(',')
+    titles = ['bulk rows/s', 'upserts/s', 'queries/s']
+    print('{:>12}'.format('profile') +
+          ''.join(['{:>14}'.format(x) for x in titles]))
+    for profile in profiles:
+        result = bench_profile(args.folder, profile, args.rows, args.upserts,
+                               args.queries)
+        print('{:>12}'.format(profile) +
+              ''.join(['{:>14.1f}'.format(result[x]) for x in titles]))
+
+
+def run_suite(args):
+    sizes = [int(x) for x in args.sizes.split(',')]
+    results = {}
+    titles = None
+    for rows in sizes:
+        result = bench_suite(args.folder, rows, args.columns,
+                             min(args.upserts, rows), args.queries)
+        if titles is None:
+            titles = list(result.keys())
+            print('{:>10}'.format('rows') +
+                  ''.join(['{:>22}'.format(x) for x in titles]))
+        print('{:>10}'.format(rows) +
+              ''.join(['{:>22.1f}'.format(result[x]) for x in titles]))
+        results[str(rows)] = result
+
+    report = {'columns': args.columns, 'upserts': args.upserts,
+              'queries': args.queries, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)['results']
+        regressions = compare(baseline, results, args.threshold)
+        for size, title, base, rate in regressions:
+            print('REGRESSION {} rows {}: {:.1f} -> {:.1f}'.format(
+                size, title, base, rate))
+        if regressions:
+            sys.exit(1)
+
+
+def main():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--rows', type=int, default=10000)
+    common.add_argument('--folder', default=BENCH_FOLDER)
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest='command')
+
+    threads = commands.add_parser('threads', help='read throughput',
+                                  parents=[common])
+    threads.add_argument('--threads', default='1,2,4,8')
+    threads.add_argument('--seconds', type=float, default=2.0)
+    threads.set_defaults(func=run_threads)
+
+    profiles = commands.add_parser('profiles', help='SQL_PROFILES',
+                                   parents=[common])
+    profiles.add_argument('--profiles',
+                          default=','.join(SSimpleDB.SQL_PROFILES.keys()))
+    profiles.add_argument('--upserts', type=int, default=1000)
+    profiles.add_argument('--queries', type=int, default=1000)
+    profiles.set_defaults(func=run_profiles)
+
+    suite = commands.add_parser('suite', help='data path against baseline',
+                                parents=[common])
+    suite.add_argument('--sizes', default=SUITE_SIZES,
+                       help='comma separated row counts')
+    suite.add_argument('--columns', type=int, default=0,
+                       help='extra String columns of the table')
+    suite.add_argument('--upserts', type=int, default=1000)
+    suite.add_argument('--queries', type=int, default=1000)
+    suite.add_argument('--output', help='JSON file of the results')
+    suite.add_argument('--baseline', help='JSON file of a previous output')
+    suite.add_argument('--threshold', type=float, default=0.2,
+                       help='ratio of the slowdown which is a regression')
+    suite.set_defaults(func=run_suite)
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        return
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
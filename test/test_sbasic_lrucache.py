@@ -0,0 +1,44 @@
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pysp.sbasic import SLRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_lru(self):
+        cache = SLRUCache(maxsize=3)
+        for i in range(3):
+            cache.set(i, str(i))
+        self.assertTrue(cache.get(0) == '0')
+        cache.set(3, '3')
+        self.assertTrue(1 not in cache)
+        self.assertTrue(cache.get(1, 'none') == 'none')
+        self.assertTrue([cache.get(i) for i in [0, 2, 3]] == ['0', '2', '3'])
+        self.assertTrue(cache.stats() == {
+            'hits': 4, 'misses': 1, 'size': 3, 'maxsize': 3})
+        cache.clear()
+        self.assertTrue(len(cache) == 0)
+
+    def test_ttl(self):
+        cache = SLRUCache(maxsize=3, ttl=0.05)
+        cache.set('a', 1)
+        self.assertTrue(cache.get('a') == 1)
+        time.sleep(0.1)
+        self.assertTrue(cache.get('a') is None)
+        self.assertTrue(len(cache) == 0)
+
+    def test_threads(self):
+        cache = SLRUCache(maxsize=10)
+
+        def work(idx):
+            for i in range(1000):
+                cache.set(i % 20, idx)
+                cache.get(i % 20)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(work, range(4)))
+        self.assertTrue(len(cache) == 10)
+        self.assertTrue(cache.hits + cache.misses == 4000)
@@ -1,14 +1,19 @@
 
+import asyncio
 import datetime
 import os
 import shutil
 import sqlalchemy as sa
+import time
 import unittest
 
+from concurrent.futures import ThreadPoolExecutor
+
 from pysp.sbasic import SFile
 from pysp.serror import SDebug
 from pysp.sconf import SConfig
-from pysp.ssql import SSimpleDB
+from pysp.scsv import SCSV
+from pysp.ssql import SAsyncSimpleDB, SShardedDB, SSimpleDB
 
 
 class SsqlTest(unittest.TestCase, SDebug, SFile):
@@ -16,6 +21,7 @@ class SsqlTest(unittest.TestCase, SDebug, SFile):
     test_folder = '/tmp/sql/'
     config_file = test_folder+'db.cfg'
     db_file = test_folder+'test.sqlite3'
+    bulk_folder = '/tmp/sql-bulk/'
 
     def test_db(self):
         if os.path.exists(self.test_folder):
@@ -26,6 +32,7 @@ class SsqlTest(unittest.TestCase, SDebug, SFile):
             self.check_upsert()
             self.check_query()
             self.check_count()
+            self.check_table_cache()
             self.check_drop_columns()
             self.check_rename_columns()
         except Exception:
@@ -159,6 +166,20 @@ tables:
         }
         self.assertTrue(db.count('inspection', *columns, **options) == 1)
 
+    def check_table_cache(self):
+        db = SSimpleDB(self.db_file, SConfig(self.config_file))
+        stats = db.table_cache_stats()
+        self.assertTrue(stats['tables'] == 1)
+        db.count('inspection')
+        db.query('inspection')
+        db.get_colnames('inspection')
+        self.assertTrue(db.table_cache_stats()['hits'] == stats['hits'] + 3)
+        self.assertTrue(db.table_cache_stats()['misses'] == stats['misses'])
+        db.invalidate_table('inspection')
+        db.count('inspection')
+        self.assertTrue(db.table_cache_misses == stats['misses'] + 1)
+        del db
+
     def check_drop_columns(self):
         DBCONFIG = '''
 tables:
@@ -217,3 +238,982 @@ tables:
         self.assertTrue(db.count('inspection', *columns, **options) == 1)
         db.vacuum()
         del db
+
+    def open_bulk_db(self, **kwargs):
+        DBCONFIG = '''
+tables:
+    - name: bulk
+      columns:
+        - [Key, Integer, PrimaryKey]
+        - [Name, String20]
+        - [Value, Float]
+        - [Date, Date]
+'''
+        if os.path.exists(self.bulk_folder):
+            shutil.rmtree(self.bulk_folder)
+        self.to_file(self.bulk_folder+'db.cfg', DBCONFIG)
+        return SSimpleDB(self.bulk_folder+'bulk.sqlite3',
+                         SConfig(self.bulk_folder+'db.cfg'), **kwargs)
+
+    def test_upsert_bulk(self):
+        db = self.open_bulk_db()
+        today = datetime.datetime.now().date()
+        rows = [{'Key': i, 'Name': 'n%d' % i, 'Date': today}
+                for i in range(1000)]
+        reports = []
+
+        def report(idx, inserted, updated):
+            reports.append((idx, inserted, updated))
+
+        options = {'data': rows, 'bulk': True, 'chunk_size': 300,
+                   'report': report}
+        self.assertTrue(db.upsert_array('bulk', **options))
+        self.assertTrue(reports == [(0, 300, 0), (1, 300, 0), (2, 300, 0),
+                                    (3, 100, 0)])
+        self.assertTrue(db.count('bulk') == 1000)
+
+        reports.clear()
+        rows = [{'Key': i, 'Value': 0.5} for i in range(900, 1100)]
+        options['data'] = rows
+        self.assertTrue(db.upsert_array('bulk', **options))
+        self.assertTrue(sum([x[1] for x in reports]) == 100)
+        self.assertTrue(sum([x[2] for x in reports]) == 100)
+        data = db.query('bulk', 'Name', 'Value', 'Date',
+                        wheres={'Key': 950})
+        self.assertTrue(data[0][0] == 'n950')
+        self.assertTrue(data[0][1] == 0.5)
+        self.assertTrue(data[0][2] == today)
+
+        options['data'] = [{'Key': 0, 'Name': 'changed'}]
+        options['only_insert'] = True
+        self.assertFalse(db.upsert_array('bulk', **options))
+        data = db.query('bulk', 'Name', wheres={'Key': 0})
+        self.assertTrue(data[0][0] == 'n0')
+
+        rows = [{'Key': 2000, 'Name': 'x'},
+                {'Key': 2000, 'Name': 'y', 'Value': 1.0},
+                {'Key': 2000, 'Name': 'z'}]
+        self.assertTrue(db.upsert_array('bulk', data=rows, bulk=True))
+        data = db.query('bulk', 'Name', 'Value', wheres={'Key': 2000})
+        self.assertTrue(tuple(data[0]) == ('z', 1.0))
+        del db
+
+    def test_query_keyset(self):
+        db = self.open_bulk_db()
+        rows = [{'Key': i, 'Name': 'n%d' % (i % 7), 'Value': float(i % 3)}
+                for i in range(100)]
+        db.upsert_array('bulk', data=rows, bulk=True)
+
+        keys = []
+        cursor = None
+        while True:
+            data, cursor = db.query_keyset('bulk', 'Key', size=30,
+                                           cursor=cursor)
+            keys += [x[0] for x in data]
+            if cursor is None:
+                break
+        self.assertTrue(keys == list(range(100)))
+
+        options = {
+            'wheres': {'Name': 'n3'},
+            'order': 'Value',
+            'size': 4,
+        }
+        names = []
+        values = []
+        while True:
+            data, cursor = db.query_keyset('bulk', 'Name', **options)
+            names += [x[0] for x in data]
+            options['cursor'] = cursor
+            if cursor is None:
+                break
+            values.append(db.decode_cursor(cursor))
+        self.assertTrue(len(names) == db.count('bulk', wheres={'Name': 'n3'}))
+        self.assertTrue(set(names) == {'n3'})
+        self.assertTrue(values == sorted(values))
+
+        values = [datetime.datetime(2020, 1, 2, 3, 4, 5, 6),
+                  datetime.datetime(2020, 1, 2, 3, 4, 5),
+                  datetime.date(2020, 1, 2), 'n1', 1.5]
+        self.assertTrue(db.decode_cursor(db.encode_cursor(values)) == values)
+        del db
+
+    def test_iter_query(self):
+        db = self.open_bulk_db()
+        rows = [{'Key': i, 'Name': 'n%d' % (i % 2)} for i in range(250)]
+        db.upsert_array('bulk', data=rows, bulk=True)
+        data = list(db.iter_query('bulk', 'Key', batch=100))
+        self.assertTrue([x[0] for x in data] == list(range(250)))
+        data = db.iter_query('bulk', 'Key', 'Name', batch=7,
+                             wheres={'Name': 'n1'})
+        self.assertTrue(len([x for x in data if x[1] == 'n1']) == 125)
+        del db
+
+    def test_threadsafe(self):
+        db = self.open_bulk_db(threadsafe=True, pool_size=4)
+
+        def work(idx):
+            for i in range(20):
+                key = idx * 100 + i
+                db.upsert('bulk', data={'Key': key, 'Name': 'n%d' % idx})
+                self.assertTrue(db.count('bulk', wheres={'Key': key}) == 1)
+                db.query('bulk', wheres={'Name': 'n%d' % idx})
+            return db.count('bulk', wheres={'Name': 'n%d' % idx})
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            counts = list(executor.map(work, range(8)))
+        self.assertTrue(counts == [20] * 8)
+        self.assertTrue(db.count('bulk') == 160)
+        del db
+
+    def test_async(self):
+        db = self.open_bulk_db()
+        del db
+        path = self.bulk_folder+'bulk.sqlite3'
+        config = SConfig(self.bulk_folder+'db.cfg')
+
+        async def work():
+            async with SAsyncSimpleDB(path, config, max_workers=4) as db:
+                writes = [db.upsert('bulk', data={'Key': i, 'Name': 'a'})
+                          for i in range(50)]
+                self.assertTrue(all(await asyncio.gather(*writes)))
+                rows = [{'Key': i, 'Name': 'b'} for i in range(50, 100)]
+                self.assertTrue(await db.upsert_array('bulk', data=rows))
+                counts = await asyncio.gather(
+                    db.count('bulk'),
+                    db.count('bulk', wheres={'Name': 'b'}))
+                data = await db.query('bulk', 'Key', size=10, page=9)
+                await db.vacuum()
+            return counts, data
+
+        counts, data = asyncio.run(work())
+        self.assertTrue(counts == [100, 50])
+        self.assertTrue([x[0] for x in data] == list(range(90, 100)))
+
+    def test_indexes(self):
+        DBCONFIG = '''
+tables:
+    - name: bulk
+      columns:
+        - [Key, Integer, PrimaryKey]
+        - [Name, String20]
+        - [Value, Float]
+      indexes:
+        - name: ix_bulk_name
+          columns: [Name]
+        - name: ix_bulk_name_value
+          columns: [Name, Value]
+          unique: true
+          where: Value > 0
+'''
+        db = self.open_bulk_db()
+        del db
+        self.to_file(self.bulk_folder+'db.cfg', DBCONFIG)
+        db = SSimpleDB(self.bulk_folder+'bulk.sqlite3',
+                       SConfig(self.bulk_folder+'db.cfg'))
+        indexes = sa.inspect(db.engine).get_indexes('bulk')
+        self.assertTrue(sorted([x['name'] for x in indexes]) ==
+                        ['ix_bulk_name', 'ix_bulk_name_value'])
+        self.assertTrue(db.get_index_where('ix_bulk_name_value') ==
+                        'Value > 0')
+        self.assertTrue(db.get_index_where('ix_bulk_name') is None)
+        del db
+
+        self.to_file(self.bulk_folder+'db.cfg',
+                     DBCONFIG.replace('[Name, Value]', '[Value, Name]'))
+        with self.assertRaises(SSimpleDB.Error):
+            SSimpleDB(self.bulk_folder+'bulk.sqlite3',
+                      SConfig(self.bulk_folder+'db.cfg'))
+        self.to_file(self.bulk_folder+'db.cfg',
+                     DBCONFIG.replace('Value > 0', 'Value > 1'))
+        with self.assertRaises(SSimpleDB.Error):
+            SSimpleDB(self.bulk_folder+'bulk.sqlite3',
+                      SConfig(self.bulk_folder+'db.cfg'))
+
+    def test_fulltext(self):
+        DBCONFIG = '''
+tables:
+    - name: bulk
+      columns:
+        - [Key, Integer, PrimaryKey]
+        - [Name, String20]
+        - [Value, Float]
+        - [Memo, String100]
+      fulltext: [Name, Memo]
+'''
+        db = self.open_bulk_db()
+        del db
+        self.to_file(self.bulk_folder+'db.cfg', DBCONFIG)
+        db = SSimpleDB(self.bulk_folder+'bulk.sqlite3',
+                       SConfig(self.bulk_folder+'db.cfg'))
+        rows = [{'Key': i, 'Name': 'name-%03d' % i, 'Memo': 'memo %d' % i}
+                for i in range(100)]
+        db.upsert_array('bulk', data=rows, bulk=True)
+        db.upsert('bulk', data={'Key': 5, 'Name': 'Changed "Q"'})
+
+        self.assertTrue('MATCH' in db.to_sql(db._build_query(
+            db.get_table('bulk'), wheres={'Name': 'e-01'})))
+        self.assertTrue(db.count('bulk', wheres={'Name': 'e-01'}) == 10)
+        self.assertTrue(db.count('bulk', wheres={'Name': 'NAME-00'}) == 9)
+        self.assertTrue(db.count('bulk', wheres={'Name': '"q"'}) == 1)
+        self.assertTrue(db.count('bulk', wheres={'Name': ['-09', '-08'],
+                                                 'Memo': '9'},
+                                 operate=SSimpleDB.OP_AND) == 11)
+        self.assertTrue(db.count('bulk', wheres={'Memo': 'o 4'}) == 11)
+        self.assertTrue(db.count('bulk', wheres={'Memo': '4'}) == 19)
+        db.vacuum()
+        self.assertTrue(db.count('bulk', wheres={'Name': 'e-01'}) == 10)
+        del db
+
+    def test_statement_cache(self):
+        db = self.open_bulk_db(statement_cache_size=4)
+        rows = [{'Key': i, 'Name': 'n%d' % i} for i in range(20)]
+        db.upsert_array('bulk', data=rows, bulk=True)
+        stats = db.statement_cache_stats()
+        for i in range(10):
+            data = db.query('bulk', 'Name', wheres={'Key': i})
+            self.assertTrue(data[0][0] == 'n%d' % i)
+            self.assertTrue(db.count('bulk', wheres={'Name': 'n1%d' % i})
+                            == (1 if i < 10 else 0))
+        self.assertTrue(db.statement_cache_stats()['misses'] ==
+                        stats['misses'] + 2)
+        self.assertTrue(db.statement_cache_stats()['hits'] ==
+                        stats['hits'] + 18)
+        data = db.query('bulk', 'Key', wheres={'Key': [3, 4]}, size=10)
+        self.assertTrue(sorted([x[0] for x in data]) == [3, 4])
+        self.assertTrue(db.statement_cache_stats()['size'] == 3)
+        db.invalidate_table('bulk')
+        self.assertTrue(db.statement_cache_stats()['size'] == 0)
+
+        # None is IS NULL, which is another statement than = 1.0.
+        db.upsert('bulk', data={'Key': 0, 'Value': 1.0})
+        self.assertTrue(db.count('bulk', wheres={'Value': None}) == 19)
+        self.assertTrue(db.count('bulk', wheres={'Value': 1.0}) == 1)
+        data = db.query('bulk', 'Key', wheres={'Value': None}, size=1)
+        self.assertTrue(data[0][0] == 1)
+        options = {'wheres': {'Value': [None, 1.0]}}
+        self.assertTrue(db.count('bulk', **options) == 20)
+        options = {'wheres': {'Value': [None]}}
+        self.assertTrue(db.count('bulk', **options) == 19)
+
+        db = self.open_bulk_db(statement_cache_size=16)
+        for i in range(10):
+            self.assertTrue(db.upsert('bulk', data={
+                'Key': i % 5, 'Name': 'u%d' % i,
+                'Date': datetime.date(2020, 1, 1 + i)}))
+        stats = db.statement_cache_stats()
+        self.assertTrue(stats['misses'] == 3 and stats['hits'] == 17)
+        self.assertTrue(db.upsert('bulk', data={
+            'Key': 1, 'Value': sa.literal(2.0) * 2}))
+        data = db.query('bulk', 'Name', 'Value', 'Date', wheres={'Key': 1})
+        self.assertTrue(tuple(data[0]) ==
+                        ('u6', 4.0, datetime.date(2020, 1, 7)))
+        del db
+
+    def test_count(self):
+        db = self.open_bulk_db()
+        rows = [{'Key': i, 'Name': 'n%d' % (i % 2)} for i in range(100)]
+        db.upsert_array('bulk', data=rows, bulk=True)
+        self.assertTrue(db.count('bulk') == 100)
+        self.assertTrue(db.count('bulk', approximate=True) == 100)
+        options = {'wheres': {'Name': 'n1'}, 'approximate': True}
+        self.assertTrue(db.count('bulk', **options) == 50)
+
+        db.upsert('bulk', data={'Key': 100, 'Name': 'n1'})
+        rows = [{'Key': i, 'Name': 'n1'} for i in range(101, 110)]
+        db.upsert_array('bulk', data=rows)
+        db.upsert_array('bulk', data=[{'Key': 110, 'Name': 'n1'}], bulk=True)
+        db.upsert('bulk', data={'Key': 0, 'Name': 'n1'})
+        self.assertTrue(db.count('bulk', approximate=True) == 111)
+        self.assertTrue(db.count('bulk', **options) == 50)
+        db.APPROX_COUNT_TTL = 0
+        self.assertTrue(db.count('bulk', **options) == 62)
+        self.assertTrue(db.count('bulk', wheres={'Name': 'n1'}) == 62)
+
+        # The unfiltered counter is counted again after the TTL.
+        engine = sa.create_engine('sqlite:///'+self.bulk_folder+'bulk.sqlite3')
+        engine.execute("INSERT INTO bulk (Key, Name) VALUES (200, 'n0')")
+        engine.dispose()
+        db.upsert('bulk', data={'Key': 201, 'Name': 'n0'})
+        self.assertTrue(db.count('bulk', approximate=True) == 113)
+        del db
+
+    def test_result_cache(self):
+        db = self.open_bulk_db(result_cache_size=16)
+        rows = [{'Key': i, 'Name': 'n%d' % (i % 2)} for i in range(10)]
+        db.upsert_array('bulk', data=rows, bulk=True)
+        options = {'wheres': {'Name': ['n0', 'n1']}, 'size': 20}
+        self.assertTrue(len(db.query('bulk', 'Key', **options)) == 10)
+        self.assertTrue(len(db.query('bulk', 'Key', **options)) == 10)
+        self.assertTrue(db.count('bulk', wheres={'Name': 'n1'}) == 5)
+        self.assertTrue(db.count('bulk', wheres={'Name': 'n1'}) == 5)
+        self.assertTrue(db.result_cache_stats()['hits'] == 2)
+
+        db.upsert('bulk', data={'Key': 10, 'Name': 'n1'})
+        self.assertTrue(len(db.query('bulk', 'Key', **options)) == 11)
+        self.assertTrue(db.count('bulk', wheres={'Name': 'n1'}) == 6)
+        db.upsert_array('bulk', data=[{'Key': 11, 'Name': 'n1'}], bulk=True)
+        self.assertTrue(db.count('bulk', wheres={'Name': 'n1'}) == 7)
+        self.assertTrue(db.result_cache_stats()['hits'] == 2)
+        del db
+
+        db = self.open_bulk_db(result_cache_size=16, result_cache_ttl=0)
+        db.count('bulk')
+        db.count('bulk')
+        self.assertTrue(db.result_cache_stats()['hits'] == 0)
+        self.assertTrue(self.open_bulk_db().result_cache_stats() is None)
+
+    def test_lookup(self):
+        db = self.open_bulk_db()
+        rows = [{'Key': i, 'Name': 'n%d' % (i % 10)} for i in range(5000)]
+        db.upsert_array('bulk', data=rows, bulk=True)
+        keys = list(range(0, 10000, 2))
+        self.assertTrue(db.count('bulk', wheres={'Key': keys}) == 2500)
+        self.assertTrue(db.count('bulk', wheres={'Key': []}) == 5000)
+
+        rv = db.lookup('bulk', 'Key', [3, 1, 3, 9999], 'Name')
+        self.assertTrue(list(rv.keys()) == [1, 3])
+        self.assertTrue(rv[3] == [('n3',)])
+        rv = db.lookup('bulk', 'Name', ['n1', 'n2'], 'Key',
+                       wheres={'Key': list(range(30))})
+        self.assertTrue(sorted([x[0] for x in rv['n2']]) == [2, 12, 22])
+        rv = db.lookup('bulk', 'Key', keys, 'Key', 'Name')
+        self.assertTrue(len(rv) == 2500)
+        self.assertTrue(rv[4998] == [(4998, 'n8')])
+
+        db.LOOKUP_TEMP_SIZE = 10
+        rv = db.lookup('bulk', 'Key', keys, 'Name', wheres={'Name': 'n4'})
+        self.assertTrue(len(rv) == 500)
+        self.assertTrue(rv[14] == [('n4',)])
+        self.assertTrue(len(db.lookup('bulk', 'Key', keys)) == 2500)
+
+        # The writes after the lookup are committed.
+        self.assertTrue(db.upsert('bulk', data={'Key': 9000, 'Name': 'x'}))
+        engine = sa.create_engine('sqlite:///'+self.bulk_folder+'bulk.sqlite3')
+        self.assertTrue(engine.execute(
+            'SELECT Name FROM bulk WHERE Key=9000').scalar() == 'x')
+        engine.dispose()
+        del db
+
+        # The keys are bound like the column, DateTime has microseconds.
+        self.to_file(self.bulk_folder+'stamp.cfg', '''
+tables:
+    - name: stamp
+      columns:
+        - [Key, Integer, PrimaryKey]
+        - [At, DateTime]
+''')
+        db = SSimpleDB(self.bulk_folder+'stamp.sqlite3',
+                       SConfig(self.bulk_folder+'stamp.cfg'))
+        stamps = [datetime.datetime(2026, 1, 1, 0, 0, i) for i in range(20)]
+        db.upsert_array('stamp', data=[{'Key': i, 'At': x}
+                                       for i, x in enumerate(stamps)])
+        self.assertTrue(len(db.lookup('stamp', 'At', stamps)) == 20)
+        db.LOOKUP_TEMP_SIZE = 10
+        rv = db.lookup('stamp', 'At', stamps, 'Key')
+        self.assertTrue(len(rv) == 20 and rv[stamps[3]] == [(3,)])
+        del db
+
+    def test_aggregate(self):
+        db = self.open_bulk_db()
+        rows = [{'Key': i, 'Name': 'n%d' % (i % 3), 'Value': float(i)}
+                for i in range(30)]
+        db.upsert_array('bulk', data=rows, bulk=True)
+        aggregates = {
+            'rows':     ('count', None),
+            'total':    ('sum', 'Value'),
+            'low':      ('min', 'Key'),
+            'mean':     ('avg', 'Value'),
+        }
+        rv = db.aggregate('bulk', 'Name', aggregates=aggregates)
+        self.assertTrue([x['Name'] for x in rv] == ['n0', 'n1', 'n2'])
+        self.assertTrue(rv[1]['rows'] == 10)
+        self.assertTrue(rv[1]['total'] == sum(range(1, 30, 3)))
+        self.assertTrue(rv[2]['low'] == 2)
+        self.assertTrue(rv[0]['mean'] == 13.5)
+
+        rv = db.aggregate('bulk', aggregates={'top': ('max', 'Value')},
+                          wheres={'Key': list(range(10))})
+        self.assertTrue(rv[0]['top'] == 9.0)
+        rv = db.aggregate('bulk', 'Name', wheres={'Name': 'n2'})
+        self.assertTrue([tuple(x) for x in rv] == [('n2',)])
+        with self.assertRaises(SSimpleDB.Error):
+            db.aggregate('bulk', aggregates={'x': ('median', 'Value')})
+        with self.assertRaises(SSimpleDB.Error):
+            db.aggregate('bulk', 'Unknown')
+        del db
+
+    def test_update_delete_where(self):
+        db = self.open_bulk_db()
+        rows = [{'Key': i, 'Name': 'n%d' % (i % 4), 'Value': 0.0}
+                for i in range(1000)]
+        db.upsert_array('bulk', data=rows, bulk=True)
+        self.assertTrue(db.count('bulk', approximate=True) == 1000)
+
+        count = db.update_where('bulk', {'Value': 1.0},
+                                wheres={'Name': 'n1'})
+        self.assertTrue(count == 250)
+        count = db.update_where('bulk', {'Value': 2.0}, limit=100,
+                                wheres={'Name': ['n2', 'n3']})
+        self.assertTrue(count == 500)
+        rv = db.aggregate('bulk', 'Value', aggregates={'n': ('count', None)})
+        self.assertTrue([tuple(x) for x in rv]
+                        == [(0.0, 250), (1.0, 250), (2.0, 500)])
+
+        count = db.delete_where('bulk', limit=70, wheres={'Value': 2.0})
+        self.assertTrue(count == 500)
+        count = db.delete_where('bulk', wheres={'Key': [0, 1, 2000]})
+        self.assertTrue(count == 2)
+        self.assertTrue(db.count('bulk', approximate=True) == 498)
+        self.assertTrue(db.count('bulk') == 498)
+        with self.assertRaises(SSimpleDB.Error):
+            db.update_where('bulk', {'Unknown': 1})
+        self.assertTrue(db.delete_where('bulk') == 498)
+        del db
+
+        # The chunks before a failed one are committed and notified.
+        db = self.open_bulk_db(result_cache_size=16)
+        db.upsert_array('bulk', data=[{'Key': i} for i in range(10)])
+        db.session.execute('CREATE TRIGGER bulk_abort BEFORE DELETE ON bulk '
+                           "WHEN old.Key = 5 BEGIN SELECT RAISE(ABORT, 'x'); "
+                           'END')
+        db.session.commit()
+        self.assertTrue(db.count('bulk') == 10)
+        self.assertTrue(db.count('bulk', approximate=True) == 10)
+        with self.assertRaises(SSimpleDB.Error):
+            db.delete_where('bulk', limit=2)
+        self.assertTrue(db.count('bulk') == 6)
+        self.assertTrue(db.count('bulk', approximate=True) == 6)
+        del db
+
+    def test_partition(self):
+        DBCONFIG = '''
+tables:
+    - name: event
+      columns:
+        - [Key, Integer, PrimaryKey]
+        - [Name, String20]
+        - [Date, Date]
+      indexes:
+        - name: ix_event_name
+          columns: [Name]
+      fulltext: [Name]
+      partition:
+        column: Date
+        period: month
+'''
+        if os.path.exists(self.bulk_folder):
+            shutil.rmtree(self.bulk_folder)
+        self.to_file(self.bulk_folder+'db.cfg', DBCONFIG)
+
+        def open_db():
+            return SSimpleDB(self.bulk_folder+'event.sqlite3',
+                             SConfig(self.bulk_folder+'db.cfg'),
+                             result_cache_size=16)
+
+        db = open_db()
+        rows = [{'Key': i, 'Name': 'name%d' % (i % 3),
+                 'Date': datetime.date(2026, 1 + i % 3, 1 + i % 28)}
+                for i in range(90)]
+        self.assertTrue(db.upsert_array('event', data=rows[:60], bulk=True))
+        self.assertTrue(db.upsert_array('event', data=rows[60:89]))
+        self.assertTrue(db.upsert('event', data=rows[89]))
+        with self.assertRaises(SSimpleDB.Error):
+            db.upsert('event', data={'Key': 100, 'Name': 'x'})
+        self.assertTrue(db.partitions('event') ==
+                        ['event_202601', 'event_202602', 'event_202603'])
+        self.assertTrue(db.count('event') == 90)
+        self.assertTrue(db.count('event', approximate=True) == 90)
+
+        # A key does not move to the partition of another period.
+        may = {'Key': 0, 'Name': 'x', 'Date': datetime.date(2026, 5, 1)}
+        with self.assertRaises(SSimpleDB.Error):
+            db.upsert('event', data=may)
+        with self.assertRaises(SSimpleDB.Error):
+            db.upsert_array('event', data=[may], bulk=True)
+        with self.assertRaises(SSimpleDB.Error):
+            db.upsert_array('event', data=[
+                dict(may, Key=200), dict(may, Key=200, Date=rows[0]['Date'])])
+        with db.buffered(max_rows=100) as wb:
+            moved = wb.upsert('event', data=may)
+        self.assertTrue(moved.exception() is not None)
+        self.assertTrue(db.upsert('event', data=dict(
+            may, Date=datetime.date(2026, 1, 20))))
+        self.assertTrue(len(db.query('event', wheres={'Key': 0})) == 1)
+        self.assertTrue(db.count('event') == 90)
+        self.assertTrue(len(db.partitions('event')) == 3)
+        db.upsert('event', data=rows[0])
+        self.assertTrue(db.count('event', wheres={'Name': 'name1'}) == 30)
+        feb = {'Date': (datetime.date(2026, 2, 1), datetime.date(2026, 3, 1))}
+        self.assertTrue(db.count('event', ranges=feb) == 30)
+        self.assertTrue(db.partitions('event', *feb['Date'])
+                        == ['event_202602'])
+        ranges = {'Date': (datetime.date(2026, 1, 10), None)}
+        self.assertTrue(db.count('event', ranges=ranges) == 79)
+
+        data = db.query('event', 'Key', order='Key', size=10, page=2)
+        self.assertTrue([x[0] for x in data] == list(range(20, 30)))
+        data = db.query('event', 'Key', order='Date', size=100,
+                        ranges=feb, wheres={'Key': [1, 4, 5]})
+        self.assertTrue(sorted([x[0] for x in data]) == [1, 4])
+        rv = db.aggregate('event', 'Name', aggregates={'n': ('count', None)})
+        self.assertTrue([tuple(x) for x in rv] ==
+                        [('name0', 30), ('name1', 30), ('name2', 30)])
+        rv = db.aggregate('event', aggregates={'n': ('count', None)})
+        self.assertTrue([tuple(x) for x in rv] == [(90,)])
+        rv = db.aggregate('event', aggregates={'n': ('count', None)},
+                          ranges=feb, wheres={'Key': [1, 4, 5]})
+        self.assertTrue([tuple(x) for x in rv] == [(2,)])
+        self.assertTrue(len(db.lookup('event', 'Key', [0, 1, 2, 200])) == 3)
+        self.assertTrue([x[0] for x in db.iter_query('event', 'Key', batch=7,
+                                                     ranges=feb)]
+                        == list(range(1, 90, 3)))
+        keys, cursor = [], None
+        while True:
+            rows, cursor = db.query_keyset('event', 'Key', size=8,
+                                           cursor=cursor, order='Date')
+            keys += [x[0] for x in rows]
+            if cursor is None:
+                break
+        self.assertTrue(sorted(keys) == list(range(90)))
+        self.assertTrue(db.export_csv(self.bulk_folder+'event.csv', 'Event',
+                                      'event', ranges=feb)['rows'] == 30)
+        self.assertTrue(list(db.iter_query('event', ranges={'Date': (
+            datetime.date(2030, 1, 1), None)})) == [])
+
+        with db.buffered(max_rows=100) as wb:
+            wb.upsert('event', data={'Key': 90, 'Name': 'name0',
+                                     'Date': datetime.date(2026, 4, 1)})
+        self.assertTrue(db.count('event') == 91)
+        self.assertTrue(db.delete_where('event', ranges={
+            'Date': (datetime.date(2026, 4, 1), None)}) == 1)
+        self.assertTrue(db.update_where('event', {'Name': 'x'},
+                                        wheres={'Name': 'name2'}) == 30)
+        self.assertTrue(db.count('event', wheres={'Name': 'name2'}) == 0)
+        del db
+
+        db = open_db()
+        self.assertTrue(len(db.partitions('event')) == 4)
+        self.assertTrue(db.count('event', wheres={'Name': 'name1'}) == 30)
+        db.drop_partition('event', 'event_202601')
+        self.assertTrue(db.count('event') == 60)
+        self.assertTrue(db.query('event', ranges={
+            'Date': (None, datetime.date(2026, 2, 1))}) == [])
+        with self.assertRaises(SSimpleDB.Error):
+            db.drop_partition('event', 'event_202601')
+        del db
+
+    def test_summary(self):
+        DBCONFIG = '''
+tables:
+    - name: sale
+      columns:
+        - [Key, Integer, PrimaryKey]
+        - [Name, String20]
+        - [Value, Float]
+      summaries:
+        - name: sale_by_name
+          groups: [Name]
+          aggregates:
+            priced: [count, Value]
+            sales: count
+            total: [sum, Value]
+        - name: sale_total
+          aggregates:
+            total: [sum, Value]
+    - name: event
+      columns:
+        - [Key, Integer, PrimaryKey]
+        - [Date, Date]
+      partition:
+        column: Date
+        period: month
+      summaries:
+        - name: event_by_date
+          groups: [Date]
+          aggregates:
+            events: count
+'''
+        if os.path.exists(self.bulk_folder):
+            shutil.rmtree(self.bulk_folder)
+        self.to_file(self.bulk_folder+'db.cfg', DBCONFIG)
+
+        def open_db():
+            return SSimpleDB(self.bulk_folder+'sale.sqlite3',
+                             SConfig(self.bulk_folder+'db.cfg'),
+                             result_cache_size=16)
+
+        def summary(db, name):
+            return [tuple(x) for x in db.query(name, size=100,
+                                                order=SSimpleDB.SUMMARY_ROWS)]
+
+        db = open_db()
+        rows = [{'Key': i, 'Name': 'n%d' % (i % 2), 'Value': float(i)}
+                for i in range(10)]
+        db.upsert_array('sale', data=rows[:6], bulk=True)
+        db.upsert_array('sale', data=rows[6:9])
+        db.upsert('sale', data=rows[9])
+        db.upsert('sale', data={'Key': 10, 'Name': None, 'Value': None})
+        self.assertTrue(summary(db, 'sale_by_name') ==
+                        [(None, 1, 0, 1, 0.0), ('n0', 5, 5, 5, 20.0),
+                         ('n1', 5, 5, 5, 25.0)])
+        self.assertTrue(summary(db, 'sale_total') == [(11, 45.0)])
+
+        db.upsert('sale', data={'Key': 1, 'Name': 'n0', 'Value': 11.0})
+        db.update_where('sale', {'Value': 0.0}, wheres={'Key': [8, 9]})
+        db.delete_where('sale', wheres={'Key': [10]})
+        self.assertTrue(summary(db, 'sale_by_name') ==
+                        [('n1', 4, 4, 4, 15.0), ('n0', 6, 6, 6, 23.0)])
+
+        db.upsert_array('event', data=[
+            {'Key': i, 'Date': datetime.date(2026, 1 + i % 2, 1)}
+            for i in range(5)])
+        self.assertTrue(summary(db, 'event_by_date') ==
+                        [(datetime.date(2026, 2, 1), 2, 2),
+                         (datetime.date(2026, 1, 1), 3, 3)])
+        db.drop_partition('event', 'event_202601')
+        self.assertTrue(summary(db, 'event_by_date') ==
+                        [(datetime.date(2026, 2, 1), 2, 2)])
+
+        db.session.execute('DELETE FROM sale_by_name')
+        db.session.commit()
+        db.rebuild_summary('sale_by_name')
+        self.assertTrue(summary(db, 'sale_by_name') ==
+                        [('n1', 4, 4, 4, 15.0), ('n0', 6, 6, 6, 23.0)])
+        del db
+
+        db = open_db()
+        db.upsert('event', data={'Key': 9, 'Date': datetime.date(2026, 2, 3)})
+        self.assertTrue(summary(db, 'event_by_date') ==
+                        [(datetime.date(2026, 2, 3), 1, 1),
+                         (datetime.date(2026, 2, 1), 2, 2)])
+        del db
+
+        for aggregate in ['[sum]', '[count, Missing]', '[count, Key, Key]']:
+            self.to_file(self.bulk_folder+'db.cfg', DBCONFIG.replace(
+                '[sum, Value]', aggregate))
+            with self.assertRaises(SSimpleDB.Error):
+                open_db()
+
+    def test_write_buffer(self):
+        db = self.open_bulk_db()
+        done = []
+        with db.buffered(max_rows=10, max_delay=60) as wb:
+            futures = [wb.upsert('bulk', data={'Key': i, 'Name': 'n'},
+                                 callback=done.append)
+                       for i in range(15)]
+            self.assertTrue(all([x.done() for x in futures[:10]]))
+            self.assertFalse(any([x.done() for x in futures[10:]]))
+            bad = wb.upsert('bulk', data={'Key': 99, 'Name': object()})
+            dup = wb.upsert('bulk', data={'Key': 0, 'Name': 'm'},
+                            only_insert=True)
+            wb.flush()
+            self.assertTrue(bad.exception() is not None)
+            self.assertTrue(dup.result() is False)
+        self.assertTrue(all([x.result() for x in futures]))
+        self.assertTrue(len(done) == 15)
+        self.assertTrue(db.count('bulk') == 15)
+        del db
+
+        db = self.open_bulk_db(threadsafe=True)
+        with db.buffered(max_rows=1000, max_delay=0.05) as wb:
+            future = wb.upsert('bulk', data={'Key': 1, 'Name': 'n'})
+            self.assertTrue(future.result(timeout=5) is True)
+            self.assertTrue(db.count('bulk') == 1)
+        del db
+
+        # A flush waiting for a write takes the queue after it.
+        db = self.open_bulk_db(threadsafe=True)
+        executor = ThreadPoolExecutor(max_workers=1)
+        with db.buffered(max_rows=1000, max_delay=60) as wb:
+            first = wb.upsert('bulk', data={'Key': 2, 'Name': 'a'})
+            with db._write_lock:
+                flushed = executor.submit(wb.flush)
+                time.sleep(0.1)
+                second = wb.upsert('bulk', data={'Key': 2, 'Name': 'b'})
+            flushed.result(timeout=5)
+            self.assertTrue(first.done() and second.done())
+            self.assertTrue(db.query('bulk', 'Name')[0][0] == 'b')
+        executor.shutdown()
+        del db
+
+    def test_migrate_resume(self):
+        class ChunkDB(SSimpleDB):
+            MIGRATE_CHUNK_SIZE = 100
+            FAIL_AFTER = None
+
+            def _migrate_chunk(self, form, last, limit=None):
+                if self.FAIL_AFTER is not None and last >= self.FAIL_AFTER:
+                    raise Exception('Interrupted')
+                return super(ChunkDB, self)._migrate_chunk(form, last, limit)
+
+        db = self.open_bulk_db()
+        rows = [{'Key': i, 'Name': 'n%d' % i, 'Value': float(i)}
+                for i in range(1050)]
+        db.upsert_array('bulk', data=rows, bulk=True)
+        del db
+        DBCONFIG = '''
+tables:
+    - name: bulk
+      columns:
+        - [Key, Integer, PrimaryKey]
+        - [Title, String20]
+        - [Date, Date]
+      migrate:
+        operation: rename
+        columns:
+            Title: Name
+'''
+        self.to_file(self.bulk_folder+'db.cfg', DBCONFIG)
+        ChunkDB.FAIL_AFTER = 500
+        with self.assertRaises(SSimpleDB.Error):
+            ChunkDB(self.bulk_folder+'bulk.sqlite3',
+                    SConfig(self.bulk_folder+'db.cfg'))
+        engine = sa.create_engine('sqlite:///'+self.bulk_folder+'bulk.sqlite3')
+        self.assertTrue(engine.execute(
+            'SELECT count(*) FROM tmp_bulk').scalar() == 600)
+        engine.execute("UPDATE bulk SET Name='changed' WHERE Key=10")
+        engine.execute("DELETE FROM bulk WHERE Key=20")
+        engine.dispose()
+
+        ChunkDB.FAIL_AFTER = None
+        db = ChunkDB(self.bulk_folder+'bulk.sqlite3',
+                     SConfig(self.bulk_folder+'db.cfg'))
+        self.assertTrue(db.get_colnames('bulk') == ['Key', 'Title', 'Date'])
+        self.assertTrue(db.count('bulk') == 1049)
+        self.assertTrue(db.query('bulk', 'Title', wheres={'Key': 10})[0][0]
+                        == 'changed')
+        self.assertTrue(db.query('bulk', 'Title', wheres={'Key': 999})[0][0]
+                        == 'n999')
+        self.assertTrue(db.migration_stats['bulk']['rows'] == 450)
+        self.assertTrue(db.migration_stats['bulk']['total'] == 1050)
+        self.assertTrue(db.migration_stats['bulk']['rows_per_sec'] > 0)
+        del db
+
+    def test_profiles(self):
+        db = self.open_bulk_db()
+        del db
+        self.to_file(self.bulk_folder+'db.cfg', '''
+sqlite:
+    profile: read-mostly
+    pragmas:
+        cache_size: -1000
+tables:
+    - name: bulk
+      columns:
+        - [Key, Integer, PrimaryKey]
+''')
+        db = SSimpleDB(self.bulk_folder+'bulk.sqlite3',
+                       SConfig(self.bulk_folder+'db.cfg'), threadsafe=True)
+        connections = [db.engine.connect() for i in range(3)]
+        for conn in connections:
+            self.assertTrue(conn.execute('PRAGMA synchronous').scalar() == 1)
+            self.assertTrue(conn.execute('PRAGMA cache_size').scalar()
+                            == -1000)
+            self.assertTrue(conn.execute('PRAGMA foreign_keys').scalar() == 1)
+            self.assertTrue(conn.execute('PRAGMA journal_mode').scalar()
+                            == 'wal')
+            conn.close()
+        del db
+        db = SSimpleDB(self.bulk_folder+'bulk.sqlite3',
+                       SConfig(self.bulk_folder+'db.cfg'), profile='durable')
+        with db.engine.connect() as conn:
+            self.assertTrue(conn.execute('PRAGMA synchronous').scalar() == 2)
+        del db
+        with self.assertRaises(SSimpleDB.Error):
+            SSimpleDB(self.bulk_folder+'bulk.sqlite3',
+                      SConfig(self.bulk_folder+'db.cfg'), profile='unknown')
+
+    def test_maintenance(self):
+        os.makedirs(self.bulk_folder, exist_ok=True)
+        for x in os.listdir(self.bulk_folder):
+            os.remove(self.bulk_folder+x)
+        self.to_file(self.bulk_folder+'db.cfg', '''
+sqlite:
+    pragmas:
+        auto_vacuum: INCREMENTAL
+tables:
+    - name: bulk
+      columns:
+        - [Key, Integer, PrimaryKey]
+        - [Name, String20]
+''')
+        db = SSimpleDB(self.bulk_folder+'bulk.sqlite3',
+                       SConfig(self.bulk_folder+'db.cfg'))
+        # The last connection which is closed checkpoints the whole WAL.
+        reader = db.engine.connect()
+        rows = [{'Key': i, 'Name': 'n%d' % i} for i in range(5000)]
+        db.upsert_array('bulk', data=rows, bulk=True)
+        db.session.execute('DELETE FROM bulk')
+        db.session.commit()
+
+        with db.maintenance(interval=60, wal_size=0, vacuum_pages=10) as mt:
+            self.assertTrue(mt.wal_bytes() > 0)
+            stats = mt.run_once()
+            self.assertTrue(stats['checkpoints'] == 1)
+            self.assertTrue(stats['vacuumed_pages'] == 10)
+            mt.truncate_size = 0
+            mt.vacuum_pages = 100000
+            mt.run_once()
+            self.assertTrue(stats['truncates'] == 1)
+            self.assertTrue(mt.wal_bytes() == 0)
+        self.assertTrue(
+            db.session.execute('PRAGMA freelist_count').scalar() == 0)
+
+        with db.maintenance(interval=0.01) as mt:
+            while mt.stats['runs'] < 2:
+                time.sleep(0.01)
+        self.assertTrue(mt.last_error is None)
+        reader.close()
+        del db
+
+    def test_query_stats(self):
+        self.assertTrue(self.open_bulk_db().query_stats is None)
+        db = self.open_bulk_db(instrument=True)
+        db.upsert_array('bulk', data=[{'Key': i, 'Name': 'n%d' % i}
+                                      for i in range(10)], bulk=True)
+        db.upsert('bulk', data={'Key': 10, 'Name': 'n10'})
+        self.assertTrue(len(db.query('bulk', size=4)) == 4)
+        self.assertTrue(db.count('bulk') == 11)
+        stats = db.query_stats.snapshot()
+        self.assertTrue(stats['upsert_array']['rows'] == 10)
+        self.assertTrue(stats['query']['count'] == 1)
+        self.assertTrue(stats['query']['rows'] == 4)
+        self.assertTrue(stats['count']['count'] == 1)
+        self.assertTrue(sum(stats['upsert']['buckets'].values())
+                        == stats['upsert']['count'])
+        self.assertTrue(not db.query_stats.slow_queries)
+        del db
+
+        db = self.open_bulk_db(slow_query=0,
+                               slow_query_log=self.bulk_folder+'slow.log')
+        db.query('bulk', wheres={'Key': 1})
+        slow = db.query_stats.slow_queries[-1]
+        self.assertTrue(slow['api'] == 'query')
+        self.assertTrue('USING INTEGER PRIMARY KEY' in slow['plan'][0])
+        with open(self.bulk_folder+'slow.log') as fd:
+            self.assertTrue(len(fd.readlines())
+                            == len(db.query_stats.slow_queries))
+        del db
+
+    def test_export_csv(self):
+        db = self.open_bulk_db()
+        rows = [{'Key': i, 'Name': 'n%d' % (i % 2), 'Value': i / 2}
+                for i in range(250)]
+        db.upsert_array('bulk', data=rows, bulk=True)
+        max_field_count = SCSV.MAX_FIELD_COUNT
+        SCSV.MAX_FIELD_COUNT = 100
+        try:
+            stats = db.export_csv(self.bulk_folder+'export.csv', 'Export',
+                                  'bulk', 'Key', 'Value', batch=30,
+                                  queue_size=2, wheres={'Name': 'n1'})
+        finally:
+            SCSV.MAX_FIELD_COUNT = max_field_count
+        self.assertTrue(stats['rows'] == 125)
+        self.assertTrue(stats['files'] == 2)
+        lines = self.read_all(self.bulk_folder+'export-000.csv').splitlines()
+        self.assertTrue(lines[2] == ',Key,Value')
+        self.assertTrue(lines[3] == '1,1,0.5')
+        self.assertTrue(len(lines) == 3 + 100)
+        lines = self.read_all(self.bulk_folder+'export-001.csv').splitlines()
+        self.assertTrue(lines[-1] == '125,249,124.5')
+        del db
+
+    def test_import_file(self):
+        db = self.open_bulk_db()
+        rows = [{'Key': i, 'Name': 'n,%d' % i, 'Value': i / 2,
+                 'Date': datetime.date(2020, 1, 1 + i % 28)}
+                for i in range(120)]
+        db.upsert_array('bulk', data=rows, bulk=True)
+        db.upsert('bulk', data={'Key': 7, 'Value': None})
+        max_field_count = SCSV.MAX_FIELD_COUNT
+        SCSV.MAX_FIELD_COUNT = 1000
+        try:
+            db.export_csv('/tmp/sql-export/export.csv', 'Export', 'bulk',
+                          to_str=True)
+        finally:
+            SCSV.MAX_FIELD_COUNT = max_field_count
+        del db
+        db = self.open_bulk_db()
+        progress = []
+        stats = db.import_file('bulk', '/tmp/sql-export/export.csv',
+                               batch=50,
+                               progress=lambda *x: progress.append(x))
+        self.assertTrue(stats['rows'] == 120)
+        self.assertTrue(progress == [(50, 50), (100, 100), (120, 120)])
+        data = db.query('bulk', wheres={'Key': [7, 30]}, size=2)
+        self.assertTrue(sorted(data) == [
+            (7, 'n,7', None, datetime.date(2020, 1, 8)),
+            (30, 'n,30', 15.0, datetime.date(2020, 1, 3))])
+
+        lines = ['{"Key": 1, "Name": "json", "Date": "2021-02-03"}',
+                 '', '{"Value": 1.5, "Key": 500}']
+        self.to_file(self.bulk_folder+'import.jsonl', '\n'.join(lines))
+        stats = db.import_file('bulk', self.bulk_folder+'import.jsonl')
+        self.assertTrue(stats['written'] == 2)
+        data = db.query('bulk', wheres={'Key': [1, 500]}, size=2)
+        self.assertTrue(sorted(data) == [
+            (1, 'json', 0.5, datetime.date(2021, 2, 3)),
+            (500, None, 1.5, None)])
+        self.to_file(self.bulk_folder+'import.jsonl',
+                     '{"Key": 501, "Unknown": 1}\n')
+        with self.assertRaises(SSimpleDB.Error):
+            db.import_file('bulk', self.bulk_folder+'import.jsonl')
+        self.assertTrue(db.count('bulk', wheres={'Key': 501}) == 0)
+
+        self.to_file(self.bulk_folder+'import.csv',
+                     'Key,Value\r\n600,2.5\r\n601,\r\n')
+        db.import_file('bulk', self.bulk_folder+'import.csv')
+        data = db.query('bulk', 'Key', 'Value', wheres={'Key': [600, 601]},
+                        size=2)
+        self.assertTrue(sorted(data) == [(600, 2.5), (601, None)])
+
+        self.to_file(self.bulk_folder+'import.csv',
+                     'Key,Name,Date\r\n602,None,2020-02-03\r\n603,,\r\n')
+        db.import_file('bulk', self.bulk_folder+'import.csv')
+        data = db.query('bulk', 'Key', 'Name', 'Date',
+                        wheres={'Key': [602, 603]}, size=2)
+        self.assertTrue(sorted(data) == [
+            (602, 'None', datetime.date(2020, 2, 3)), (603, '', None)])
+        self.to_file(self.bulk_folder+'import.csv',
+                     'Key,Name,Comment\r\n1,a,x\r\n2,b,y\r\n3,c,z\r\n')
+        with self.assertRaises(SSimpleDB.Error):
+            db.import_file('bulk', self.bulk_folder+'import.csv')
+        with self.assertRaises(SSimpleDB.Error):
+            db.import_file('bulk', self.bulk_folder+'import.csv',
+                           format='scsv')
+        data = db.query('bulk', 'Name', wheres={'Key': [1, 2]}, size=2)
+        self.assertTrue(sorted(data) == [('json',), ('n,2',)])
+        del db
+
+    def test_sharded(self):
+        db = self.open_bulk_db()
+        del db
+        paths = [self.bulk_folder+'shard%d.sqlite3' % i for i in range(3)]
+        for options in [{}, {'partition': 'range', 'bounds': [30, 60]}]:
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            sdb = SShardedDB(paths, SConfig(self.bulk_folder+'db.cfg'),
+                             **options)
+            rows = [{'Key': i, 'Name': 'n%d' % (i % 3)} for i in range(99)]
+            self.assertTrue(sdb.upsert_array('bulk', data=rows, bulk=True))
+            self.assertTrue(sdb.upsert('bulk', data={'Key': 99, 'Name': 'n0'}))
+            counts = [x.count('bulk') for x in sdb.shards]
+            self.assertTrue(sum(counts) == 100)
+            self.assertTrue(all([x > 0 for x in counts]))
+            if options:
+                self.assertTrue(counts == [30, 30, 40])
+            self.assertTrue(sdb.count('bulk', wheres={'Name': 'n0'}) == 34)
+
+            data = sdb.query('bulk', 'Name', size=7, page=3)
+            self.assertTrue([x[0] for x in data] ==
+                            ['n%d' % (i % 3) for i in range(21, 28)])
+            data = sdb.query('bulk', wheres={'Name': 'n1'}, size=10, page=3)
+            self.assertTrue([x[0] for x in data] == [91, 94, 97])
+            self.assertTrue(sdb.update_where('bulk', {'Name': 'n9'},
+                                             wheres={'Name': 'n1'}) == 33)
+            self.assertTrue(sdb.delete_where('bulk',
+                                             wheres={'Name': 'n9'}) == 33)
+            self.assertTrue(sdb.count('bulk') == 67)
+            sdb.close()